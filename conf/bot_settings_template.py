@@ -28,6 +28,14 @@ IRC_QUIT_MESSAGES = (
     "They shall see me and remember who is the real King under the Mountain!",
 )
 IRC_LOGDIR = 'logs/irc'
+# Outbound lines per second, and burst size. Most servers will 
+# disconnect a client which sends faster than one line every 2 seconds.
+IRC_FLOOD_RATE = 0.5
+IRC_FLOOD_BURST = 5
+# Seconds to wait before reconnecting. The delay doubles after 
+# each failed attempt, up to the maximum.
+IRC_RECONNECT_MIN_DELAY = 2
+IRC_RECONNECT_MAX_DELAY = 300
 IRC_MODULES = (
     'google',
     'logs',
@@ -43,6 +51,8 @@ IRC_MODULES = (
 
 DISCORD_TOKEN = "<CUSTOMIZE>"
 DISCORD_SERVER_NAME = '<CUSTOMIZE>'
+# Optional, saves looking up the server by name
+DISCORD_SERVER_ID = None
 DISCORD_CHANNELS = ('#general',)
 DISCORD_LOGDIR = 'logs/discord'
 DISCORD_MODULES = (
@@ -59,11 +69,61 @@ DISCORD_MODULES = (
 )
 
 DISCORD_ALERTS = ('streaming','playing')
+# Outbound messages per second, and burst size, for each channel or user
+DISCORD_SEND_RATE = 1.0
+DISCORD_SEND_BURST = 5
+# Seconds a user must stay offline before they are considered gone.
+# This avoids a flood of join/leave events from flapping connections.
+DISCORD_PRESENCE_DEBOUNCE = 30
 
 ACCESS_NEEDS_AUTH = 3
 
 WEB_BASE_URL="http://<CUSTOMIZE>/ircview"
 
+# Shared HTTP client used by plugins: maximum connections overall and 
+# per host, seconds to cache DNS results, and default request timeout
+#HTTP_POOL_SIZE = 20
+#HTTP_POOL_SIZE_PER_HOST = 4
+#HTTP_DNS_CACHE_TTL = 300
+#HTTP_TIMEOUT = 15
+
+# Responses from external services (Google, YouTube, comic pages) are 
+# cached in this SQLite file, so they survive restarts. Entries expire 
+# after the TTL for their namespace (in seconds), lookups which found 
+# nothing after the negative TTL, and the least recently used entries 
+# are evicted beyond the maximum size.
+RESPONSE_CACHE_FILE = 'logs/responses.db'
+#RESPONSE_CACHE_SIZE = 10000
+#RESPONSE_CACHE_TTLS = { 'google': 60*60*24, 'youtube': 60*60*6, 'comic': 60*60*24*30 }
+#RESPONSE_CACHE_DEFAULT_TTL = 60*60
+#RESPONSE_CACHE_NEGATIVE_TTL = 60*10
+
+# Who is online, and when they last spoke, is kept in memory. The times
+# users last spoke are saved to their profiles every this many seconds.
+#PRESENCE_FLUSH_INTERVAL = 60
+
 GOOGLE_DEVELOPER_KEY="<CUSTOMIZE>"
 GOOGLE_CUSTOM_SEARCH_CX="<CUSTOMIZE>"
 
+# Custom Search endpoint (may point to a local stand-in for testing),
+# and the number of seconds to wait for it
+#GOOGLE_SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+#GOOGLE_SEARCH_TIMEOUT = 10
+
+# YouTube Data API videos endpoint, timeout in seconds, and the 
+# number of videos whose metadata is remembered
+#YOUTUBE_API_URL = "https://www.googleapis.com/youtube/v3/videos"
+#YOUTUBE_API_TIMEOUT = 10
+#YOUTUBE_CACHE_SIZE = 500
+
+# Seconds before the in-memory quote index is rebuilt from the database
+#QUOTE_INDEX_REFRESH = 3600
+
+# Hours for which polls are open, and days after closing that they are deleted
+#POLL_DURATION = 24*7
+#POLL_EXPIRY = 90
+
+# Number of URLs remembered per channel, and an optional file 
+# in which they are kept between restarts
+URL_HISTORY_SIZE = 100
+URL_HISTORY_FILE = 'logs/urls.json'
@@ -4,9 +4,13 @@ from smaug.bot import settings
 from smaug.bot.irc import SmaugIRCFactory
 from smaug.bot.discord import SmaugDiscord
 from smaug.bot.command import *
+from smaug.bot.http import HttpClient
+from smaug.bot.cache import ResponseCache
+from smaug.bot.presence import PresenceRegistry
 from smaug.ircview import models
 
 from django.contrib.auth.models import AnonymousUser
+from datetime import datetime
 from functools import partial
 from importlib import import_module,reload
 from inspect import isclass
@@ -18,6 +22,10 @@ import signal
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of listener notifications dispatched concurrently
+# when a protocol reports many users at once
+NOTIFY_BATCH_SIZE = 25
+
 
 class SmaugBot(object):
     
@@ -32,6 +40,16 @@ class SmaugBot(object):
         self.listeners = {}
         self.cmds = {}
         self.dynamicCode = ""
+        self.http = HttpClient(settings.HTTP_POOL_SIZE,
+                settings.HTTP_POOL_SIZE_PER_HOST,
+                settings.HTTP_DNS_CACHE_TTL,
+                settings.HTTP_TIMEOUT)
+        self.cache = ResponseCache(settings.RESPONSE_CACHE_FILE,
+                settings.RESPONSE_CACHE_SIZE,
+                settings.RESPONSE_CACHE_TTLS,
+                settings.RESPONSE_CACHE_DEFAULT_TTL,
+                settings.RESPONSE_CACHE_NEGATIVE_TTL)
+        self.presence = PresenceRegistry(settings.PRESENCE_FLUSH_INTERVAL)
         self.me = self.getUserByHandle(settings.BOT_NAME)
 
         logger.info("Starting Smaug Bot...")
@@ -117,6 +135,17 @@ class SmaugBot(object):
         raise Exception("Module %s does not define a Plugin" % module)
 
 
+    def unloadPlugin(self, moduleName):
+        """ Let a plugin save its state before it goes away
+        """
+        plugin = self.plugins.get(moduleName)
+        if isinstance(plugin, Plugin):
+            try:
+                plugin.unload()
+            except Exception:
+                logger.exception("Error unloading plugin %s" % moduleName)
+
+
     def addPlugin(self, moduleName, plugin):
         self.plugins[moduleName] = plugin
         self.addListeners(moduleName, plugin)
@@ -164,13 +193,50 @@ class SmaugBot(object):
             return None
         
 
+    def normalizeHandle(self, handle):
+        """ Strip everything after the pipe and lowercase the handle
+        """
+        return handle.split("|", 1)[0].lower()
+
+
     def getUserByHandle(self, handle):
-        h = handle.split("|", 1)
-        users = models.SmaugUser.objects.filter(profile__handles__handle__exact=h[0].lower())
+        users = models.SmaugUser.objects.filter(profile__handles__handle__exact=self.normalizeHandle(handle))
         if users: return users[0]
         return None
 
 
+    def getUsersByHandles(self, handles):
+        """ Resolve many handles with a single query.
+            Returns a dict mapping each normalized handle to its user.
+            Handles without a user are left out.
+        """
+        keys = set([self.normalizeHandle(h) for h in handles])
+        users = {}
+        if not keys: return users
+        q = models.SmaugUserHandle.objects.filter(handle__in=keys).select_related('profile__user')
+        for h in q:
+            key = h.handle.lower()
+            if key not in users:
+                users[key] = h.profile.user
+        return users
+
+
+    def updateSignOn(self, users, when=None):
+        """ Set the sign on time for many users with a single UPDATE
+        """
+        ids = [user.id for user in users]
+        if ids:
+            models.SmaugUserProfile.objects.filter(user_id__in=ids).update(sign_on=when or datetime.now())
+
+
+    def updateSignOff(self, users, when=None):
+        """ Set the sign off time for many users with a single UPDATE
+        """
+        ids = [user.id for user in users]
+        if ids:
+            models.SmaugUserProfile.objects.filter(user_id__in=ids).update(sign_off=when or datetime.now())
+
+
     def getUser(self, userId):
         """ Return a user with the given userId
         """
@@ -219,6 +285,7 @@ class SmaugBot(object):
             should call this method to notify any listeners.
             event can be hear, hearEnter, or hearExit 
         """
+        self.presence.update(context, eventType)
         for moduleName in self.listeners[eventType]:
             try:
                 callback = self.listeners[eventType][moduleName]
@@ -228,6 +295,15 @@ class SmaugBot(object):
                 logger.exception("Error notifying listeners")
 
 
+    async def notifyListenersBatch(self, contexts, eventType, message=""):
+        """ Notify listeners on behalf of many contexts. At most 
+            NOTIFY_BATCH_SIZE contexts are dispatched concurrently.
+        """
+        for i in range(0, len(contexts), NOTIFY_BATCH_SIZE):
+            batch = contexts[i:i+NOTIFY_BATCH_SIZE]
+            await asyncio.gather(*[self.notifyListeners(c, eventType, message) for c in batch])
+
+
     async def execute(self, cmd, c, args, authed=True):
         """ execute a command on behalf of an interface
             command: name of command to execute
@@ -280,6 +356,11 @@ class SmaugBot(object):
         try:
             # Wait until each client dies
             await self.closeClients()
+            for moduleName in list(self.plugins):
+                self.unloadPlugin(moduleName)
+            await self.http.close()
+            self.cache.close()
+            self.presence.flush()
             # Gather all remaining tasks and cancel them
             pending = [t for t in asyncio.Task.all_tasks(loop=self.loop) if t is not asyncio.tasks.Task.current_task()]
             gathered = asyncio.gather(*pending, loop=self.loop)
@@ -404,6 +485,7 @@ class SmaugBot(object):
         module = import_module("smaug.bot.plugins."+moduleName)
         try:
             reload(module)
+            self.unloadPlugin(moduleName)
             self.addPlugin(moduleName, self.newPlugin(module))
 
             # load the module for every protocol that needs it, 
@@ -417,6 +499,35 @@ class SmaugBot(object):
             await c.reply(str(e))
 
 
+    @command("http")
+    @level(50)
+    @usage("!http")
+    @desc("Show HTTP client statistics")
+    async def showHttp(self, c, args):
+        await c.reply("HTTP client: %s" % self.http)
+
+
+    @command("cache")
+    @level(50)
+    @usage("!cache")
+    @desc("Show response cache statistics")
+    async def showCache(self, c, args):
+        content = []
+        for namespace, (entries, hits, misses) in sorted(self.cache.getStats().items()):
+            content.append("%s: %d entries, %d hits, %d misses" % (namespace, entries, hits, misses))
+        if not content:
+            content.append("Response cache is empty")
+        await c.reply(content)
+
+
+    @command("presence")
+    @level(50)
+    @usage("!presence")
+    @desc("Show presence registry statistics")
+    async def showPresence(self, c, args):
+        await c.reply("Presence: %s" % self.presence)
+
+
     @command("tasks")
     @level(50)
     @usage("!tasks")
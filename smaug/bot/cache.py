@@ -0,0 +1,128 @@
+"""
+Persistent cache for responses from external services.
+
+Entries are kept in SQLite so that they survive restarts. Each entry
+belongs to a namespace (e.g. "google" or "youtube") with its own time
+to live. A None value records that a lookup found nothing, and expires
+after the shorter negative TTL. When the cache grows past its maximum
+size, the least recently used entries are evicted.
+"""
+
+import json
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+# Returned by get() when there is no live entry for a key
+MISS = object()
+
+
+class ResponseCache(object):
+    """ filename: SQLite database file, or ":memory:"
+        maxEntries: number of entries kept, across all namespaces
+        ttls: dict of namespace to time to live, in seconds
+        defaultTtl: time to live for namespaces not in ttls
+        negativeTtl: time to live for None values
+    """
+
+    # Check the size every this many puts
+    EVICT_INTERVAL = 100
+
+    def __init__(self, filename, maxEntries, ttls, defaultTtl, negativeTtl):
+        self.filename = filename
+        self.maxEntries = maxEntries
+        self.ttls = ttls
+        self.defaultTtl = defaultTtl
+        self.negativeTtl = negativeTtl
+        self.hits = {}
+        self.misses = {}
+        self.puts = 0
+        self.db = sqlite3.connect(filename, isolation_level=None)
+        self.db.execute("""create table if not exists response_cache (
+                namespace text not null,
+                key text not null,
+                value text,
+                expires real not null,
+                accessed real not null,
+                primary key (namespace, key))""")
+        self.db.execute("""create index if not exists response_cache_accessed
+                on response_cache (accessed)""")
+        self.purgeExpired()
+
+
+    def get(self, namespace, key):
+        """ Returns the cached value, which may be None for a negative
+            entry, or MISS if there is no live entry.
+        """
+        now = time.time()
+        row = self.db.execute("""select value from response_cache
+                where namespace=? and key=? and expires>?""",
+                (namespace, key, now)).fetchone()
+        if row is None:
+            self.misses[namespace] = self.misses.get(namespace, 0) + 1
+            return MISS
+        self.hits[namespace] = self.hits.get(namespace, 0) + 1
+        self.db.execute("""update response_cache set accessed=?
+                where namespace=? and key=?""", (now, namespace, key))
+        return json.loads(row[0])
+
+
+    def put(self, namespace, key, value):
+        now = time.time()
+        if value is None:
+            ttl = self.negativeTtl
+        else:
+            ttl = self.ttls.get(namespace, self.defaultTtl)
+        self.db.execute("""insert or replace into response_cache
+                (namespace, key, value, expires, accessed) values (?,?,?,?,?)""",
+                (namespace, key, json.dumps(value), now+ttl, now))
+        self.puts += 1
+        if self.puts % self.EVICT_INTERVAL == 0:
+            self.evict()
+
+
+    async def fetch(self, namespace, key, fetcher):
+        """ Returns the cached value for the key, or else awaits
+            fetcher() and caches its result. Exceptions raised by
+            fetcher are not cached.
+        """
+        value = self.get(namespace, key)
+        if value is MISS:
+            value = await fetcher()
+            self.put(namespace, key, value)
+        return value
+
+
+    def purgeExpired(self):
+        self.db.execute("delete from response_cache where expires<=?", (time.time(),))
+
+
+    def evict(self):
+        """ Remove expired entries, then the least recently used
+            entries until the cache is back under its maximum size.
+        """
+        self.purgeExpired()
+        count = self.db.execute("select count(*) from response_cache").fetchone()[0]
+        if count > self.maxEntries:
+            self.db.execute("""delete from response_cache where rowid in
+                    (select rowid from response_cache order by accessed limit ?)""",
+                    (count - self.maxEntries,))
+            logger.debug("Evicted %d cache entries" % (count - self.maxEntries))
+
+
+    def getStats(self):
+        """ Returns a dict of namespace to (entries, hits, misses)
+        """
+        stats = {}
+        for namespace, count in self.db.execute("""select namespace, count(*)
+                from response_cache group by namespace"""):
+            stats[namespace] = count
+        namespaces = set(stats) | set(self.hits) | set(self.misses)
+        return dict((ns, (stats.get(ns, 0), self.hits.get(ns, 0), self.misses.get(ns, 0))) \
+                for ns in namespaces)
+
+
+    def close(self):
+        self.db.close()
@@ -13,7 +13,12 @@ class Plugin(object):
         marked with @command or @listen decorations in order to 
         expose them to the bot framework. 
     """
-    pass
+
+    def unload(self):
+        """ Called before the plugin is replaced by a reload, 
+            and when the bot shuts down
+        """
+        pass
 
 
 class CmdParamError(Exception):
@@ -13,10 +13,13 @@ import discord
 
 from .log import DiscordLogger
 from .protocol import Protocol
+from .sendqueue import SendQueue, TokenBucket
+from . import formatting
 from .command import *
 from . import settings
 from smaug.utils import dates
 
+import asyncio
 import logging
 import time
 from datetime import datetime
@@ -24,10 +27,34 @@ from django.db import connection as djangodb
 
 logger = logging.getLogger(__name__)
 
+# Discord rejects messages longer than this
+MAX_MESSAGE_LENGTH = 2000
+
 # Needed due to https://code.djangoproject.com/ticket/21597#comment:29
 def close_db():
     djangodb.close()
 
+def getRetryAfter(e):
+    """ If the exception is a 429, return the number of seconds
+        Discord asked us to wait before trying again.
+    """
+    if isinstance(e, discord.HTTPException) and e.status == 429:
+        headers = e.response.headers
+        for header in ('Retry-After','X-RateLimit-Reset-After'):
+            if header in headers:
+                return float(headers[header])
+        return 1.0
+    return None
+
+
+async def sendToTarget(target, text, em):
+    await target.send(text or None, embed=em)
+
+
+def isStreaming(activity):
+    return bool(activity) and activity.type.name == "streaming"
+
+
 def getChannelName(channel):
     if not channel: return None
     if isinstance(channel, discord.DMChannel):
@@ -75,6 +102,17 @@ class SmaugDiscord(discord.Client, Protocol):
         self.channels = None
         self.ready = False
         self.gameStartTimes = {}
+        # lowercased name/nick -> discord.Member
+        self.membersByName = {}
+        self.membersByNick = {}
+        # channel name -> discord.TextChannel
+        self.channelsByName = {}
+        # target id -> SendQueue
+        self.sendQueues = {}
+        # id of the guild whose presence events we process
+        self.guildId = settings.DISCORD_SERVER_ID
+        # member id -> handle for a deferred userSeenLeaving
+        self.pendingExits = {}
     
         logger.info("Discord bot configuration:")
         logger.info("channels: %s" % self.channelNames)
@@ -114,16 +152,27 @@ class SmaugDiscord(discord.Client, Protocol):
                         if user:
                             user.profile.sign_off = datetime.now()
                             user.profile.save()
+        self.cmd.presence.disconnected(self.proto)
 
     
     # Event handlers
 
     async def on_ready(self):
+
+        # the client's cache is rebuilt on every reconnect
+        self.buildIndexes()
         
         if self.ready: return
 
         self.cmd.registerProtocol(self)
 
+        if not self.guildId:
+            guild = discord.utils.get(self.guilds, name=settings.DISCORD_SERVER_NAME)
+            if guild:
+                self.guildId = guild.id
+            else:
+                logger.error("Could not find server '%s'" % settings.DISCORD_SERVER_NAME)
+
         self.private_channel = SmaugChannel(None, self, self.logdir)
         self.channels = {}
         for channel in self.get_all_channels():
@@ -134,6 +183,8 @@ class SmaugDiscord(discord.Client, Protocol):
                     sc = SmaugChannel(channel, self, self.logdir)
                     self.channels[sc.name] = sc
                     await self.joined(channel)
+
+        await self.syncPresence()
         
         logger.info("Discord client is now ready")
         self.ready = True
@@ -145,8 +196,39 @@ class SmaugDiscord(discord.Client, Protocol):
             self.getLog(channel).topic(channel.topic.rstrip())
         c = CommandContext(self, getChannelName(channel), None, None, time.time())
         await self.cmd.notifyListeners(c, "joined", channel.name)
+
+
+    async def syncPresence(self):
+        """ Mark every member we can see as entering. This is the bulk 
+            version of userSeenEntering: all the users are resolved with 
+            one query, their sign on times are saved with one UPDATE, 
+            and the listeners are notified in batches.
+        """
+        members = {}
         for member in self.get_all_members():
-            await self.userSeenEntering(member, None)
+            members[self.getHandle(member)] = member
+
+        users = self.cmd.getUsersByHandles(members.keys())
+        logger.info("Syncing presence for %d members (%d known users)" % (len(members),len(users)))
+
+        now = time.time()
+        seen = {}
+        entered = []
+        heardEntering = []
+        for handle, member in members.items():
+            user = users.get(self.cmd.normalizeHandle(handle))
+            if not user or user.id in seen: continue
+            seen[user.id] = user
+            c = CommandContext(self, None, user, self.getNick(member), now)
+            if user.id==self.user.id:
+                entered.append(c)
+            else:
+                heardEntering.append(c)
+
+        self.cmd.updateSignOn(seen.values())
+        await self.cmd.notifyListenersBatch(entered, "enter", ())
+        await self.cmd.notifyListenersBatch(heardEntering, "hearEnter", ())
+        close_db()
 
 
     async def on_error(self, event, *args, **kwargs):
@@ -156,27 +238,62 @@ class SmaugDiscord(discord.Client, Protocol):
         logger.info("Resumed")
 
 
+    async def on_guild_join(self, guild):
+        self.buildIndexes()
+
+
+    async def on_guild_remove(self, guild):
+        self.buildIndexes()
+
+
+    async def on_member_join(self, member):
+        self.indexMember(member)
+
+
+    async def on_member_remove(self, member):
+        self.unindexMember(member)
+
+
+    async def on_user_update(self, before, after):
+        if before.name != after.name:
+            for guild in self.guilds:
+                member = guild.get_member(after.id)
+                if member:
+                    self.unindexMember(before, guild)
+                    self.indexMember(member)
+
+
     async def on_member_update(self, before, after):
 
-        logger.info("Member update for %s on %s"%(after,after.guild.name))
+        if before.nick != after.nick:
+            self.unindexMember(before)
+            self.indexMember(after)
 
-        if after.guild.name != settings.DISCORD_SERVER_NAME:
+        if not self.isRelevantUpdate(before, after):
             return
 
+        logger.info("Member update for %s on %s"%(after,after.guild.name))
+
         if before.status==discord.Status.offline and after.status==discord.Status.online:
-            for sc in self.channels.values():
-                await self.userSeenEntering(after, sc.channel)
+            handle = self.pendingExits.pop(after.id, None)
+            if handle:
+                # they were only gone for a moment, so it's like they never left
+                handle.cancel()
+                logger.info("Ignoring flapping presence for %s"%after)
+            else:
+                for sc in self.channels.values():
+                    await self.userSeenEntering(after, sc.channel)
 
         elif before.status==discord.Status.online and after.status==discord.Status.offline:
-            for sc in self.channels.values():
-                await self.userSeenLeaving(after, sc.channel)
+            self.scheduleExit(after)
 
         if before.nick != after.nick:
+            user = self.getUser(self.getHandle(after))
+            beforeNick = self.getNick(before)
+            afterNick = self.getNick(after)
             for sc in self.channels.values():
-                user = self.getUser(self.getHandle(after))
-                beforeNick = self.getNick(before)
-                afterNick = self.getNick(after)
                 self.getLog(sc.channel).nick(user, beforeNick, afterNick)
+            self.cmd.presence.renamed(self.proto, beforeNick, afterNick)
 
         if "playing" in self.alerts:
             await self.alert_playing_changes(before, after)
@@ -186,6 +303,46 @@ class SmaugDiscord(discord.Client, Protocol):
         close_db()
 
 
+    def isRelevantUpdate(self, before, after):
+        """ Presence updates arrive for every status and activity change 
+            in every guild. This decides cheaply whether an update is one 
+            we act on, before any logging or database access happens.
+        """
+        if after.guild.id != self.guildId:
+            return False
+        if before.nick != after.nick:
+            return True
+        statuses = (before.status, after.status)
+        if statuses == (discord.Status.offline, discord.Status.online) or \
+                statuses == (discord.Status.online, discord.Status.offline):
+            return True
+        if "streaming" in self.alerts and \
+                isStreaming(before.activity) != isStreaming(after.activity):
+            return True
+        return False
+
+
+    def scheduleExit(self, member):
+        """ Process a member going offline after the debounce window, 
+            unless they come back online before then.
+        """
+        window = settings.DISCORD_PRESENCE_DEBOUNCE
+        if not window:
+            asyncio.ensure_future(self.memberLeft(member))
+            return
+        old = self.pendingExits.pop(member.id, None)
+        if old: old.cancel()
+        self.pendingExits[member.id] = self.loop.call_later(window, 
+                lambda: asyncio.ensure_future(self.memberLeft(member)))
+
+
+    async def memberLeft(self, member):
+        self.pendingExits.pop(member.id, None)
+        for sc in self.channels.values():
+            await self.userSeenLeaving(member, sc.channel)
+        close_db()
+
+
     async def alert_playing_changes(self, before, after):
         # TODO: this could be reimplemented, but it's probably too spammy anyway
         pass
@@ -219,10 +376,7 @@ class SmaugDiscord(discord.Client, Protocol):
         if content:
             logger.info("Sending content: %s"%content)
             for channel in self.channels:
-                # We have to send each line individually so
-                # that they line up correctly
-                for line in content:
-                    await self.sendMessage(channel, line)
+                await self.sendMessage(channel, content)
 
 
 
@@ -325,8 +479,7 @@ class SmaugDiscord(discord.Client, Protocol):
             await self.cmd.notifyListeners(context, "hear", content)
 
         if authed:
-            user.profile.last_comment = datetime.now()
-            user.profile.save()
+            self.cmd.presence.heard(context)
 
         close_db()
   
@@ -370,10 +523,22 @@ class SmaugDiscord(discord.Client, Protocol):
         logger.info("Reactions cleared: %s" % reactions)
 
 
-    async def on_channel_update(self, before, after):
+    async def on_guild_channel_create(self, channel):
+        self.indexChannel(channel)
+
+
+    async def on_guild_channel_delete(self, channel):
+        self.unindexChannel(channel)
+
+
+    async def on_guild_channel_update(self, before, after):
         logger.info("Channel was updated: %s", after)
-        if before.topic != after.topic:
-            self.getLog(after).topicChanged(after.topic.rstrip())
+        if before.name != after.name:
+            self.unindexChannel(before)
+            self.indexChannel(after)
+        if isinstance(after, discord.TextChannel) and before.topic != after.topic \
+                and self.channels is not None and getChannelName(after) in self.channels:
+            self.getLog(after).topicChanged((after.topic or "").rstrip())
     
 
     async def die(self):
@@ -388,7 +553,8 @@ class SmaugDiscord(discord.Client, Protocol):
 
 
     async def sendMessage(self, where, content, em=None):
-        """ Implements protocol
+        """ Implements protocol. The content is queued for the target, 
+            and this returns once it has been delivered.
         """
         line = self.getMessage(content)
         if line:
@@ -402,22 +568,94 @@ class SmaugDiscord(discord.Client, Protocol):
                     target = self.getDiscordMemberByName(where)
                 if not target:
                     raise Exception("Could not resolve target '%s'"%where)
-            await target.send(line, embed=em)
+            await self.getSendQueue(target).put(line, em)
+
+
+    def getSendQueue(self, target):
+        """ Returns the outbound queue for the given channel or member.
+            Each one gets its own bucket because Discord rate limits 
+            sends per channel.
+        """
+        sq = self.sendQueues.get(target.id)
+        if not sq:
+            bucket = TokenBucket(settings.DISCORD_SEND_RATE, settings.DISCORD_SEND_BURST)
+            sq = SendQueue(target, sendToTarget, bucket, MAX_MESSAGE_LENGTH, 
+                    joiner="\n", retryAfter=getRetryAfter)
+            self.sendQueues[target.id] = sq
+        # the client may have replaced the object since we last saw it
+        sq.destination = target
+        return sq
 
 
     def getDiscordChannelByName(self, name):
-        return discord.utils.get(self.get_all_channels(), name=name)
+        return self.channelsByName.get(name)
 
 
     def getDiscordMemberByName(self, name):
+        """ Find a member by name, or failing that, by nick
+        """
+        key = name.lower()
+        return self.membersByName.get(key) or self.membersByNick.get(key)
+
+
+    # Name indexes
+    
+    def buildIndexes(self):
+        """ Index all the members and text channels we can see, 
+            so that outbound messages can be routed by name.
+        """
+        self.membersByName = {}
+        self.membersByNick = {}
+        self.channelsByName = {}
         for member in self.get_all_members():
-            if member.name.lower() == name.lower():
-                return member
-            try:
-                if member.nick.lower() == name.lower():
-                    return member
-            except:
-                pass
+            self.indexMember(member)
+        for channel in self.get_all_channels():
+            self.indexChannel(channel)
+        logger.info("Indexed %d member names and %d channels" % (len(self.membersByName),len(self.channelsByName)))
+
+
+    def indexMember(self, member):
+        self.membersByName[member.name.lower()] = member
+        if getattr(member, 'nick', None):
+            self.membersByNick[member.nick.lower()] = member
+
+
+    def unindexMember(self, member, guild=None):
+        """ Remove a member's name and nick from the indexes. If the same
+            user is a member of another guild, they are indexed from there,
+            and any other member with the same name or nick takes its place.
+        """
+        guild = guild or member.guild
+        for index, attr in ((self.membersByName, 'name'), (self.membersByNick, 'nick')):
+            name = getattr(member, attr, None)
+            if not name: continue
+            key = name.lower()
+            indexed = index.get(key)
+            if indexed and indexed.id==member.id and indexed.guild.id==guild.id:
+                del index[key]
+                # someone else may go by the same name
+                for other in self.get_all_members():
+                    if other.id==member.id and other.guild.id==guild.id: continue
+                    otherName = getattr(other, attr, None)
+                    if otherName and otherName.lower()==key:
+                        index[key] = other
+                        break
+
+        for other in self.guilds:
+            if other.id != guild.id:
+                m = other.get_member(member.id)
+                if m: self.indexMember(m)
+
+
+    def indexChannel(self, channel):
+        if isinstance(channel, discord.TextChannel):
+            self.channelsByName[channel.name] = channel
+
+
+    def unindexChannel(self, channel):
+        indexed = self.channelsByName.get(channel.name)
+        if indexed and indexed.id==channel.id:
+            del self.channelsByName[channel.name]
 
 
     # Commands
@@ -463,6 +701,17 @@ class SmaugDiscord(discord.Client, Protocol):
         await self.sendNotification(who, message)
 
 
+    @command("sendq")
+    @level(20)
+    @usage("!sendq")
+    @desc("Show the outbound message queues and their latency.")
+    async def showSendQueues(self, c, args):
+        content = ["Send queues:"]
+        for sq in self.sendQueues.values():
+            content.append("  %s" % sq)
+        await c.reply(content)
+
+
     @command("playing")
     @level(20)
     @usage("!playing <game>")
@@ -550,15 +799,10 @@ class SmaugDiscord(discord.Client, Protocol):
         """ Implements protocol
         """
         if not s: return None
-        codes = {
-            'italic'     : '*',
-            'bold'       : '**',
-            'underline'  : '__',
-        }
 
         for k in list(attrib.keys()):
-            if k in codes:
-                code = codes[k]
+            if k in formatting.DISCORD_CODES:
+                code = formatting.DISCORD_CODES[k]
                 s = code + s + code
 
         return s
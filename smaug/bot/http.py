@@ -0,0 +1,80 @@
+"""
+Shared HTTP client for plugins.
+
+A single aiohttp session is kept for the life of the bot, so that
+connections and DNS lookups are reused across requests. Plugins get
+it from the bot, e.g. c.protocol.cmd.http
+"""
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClient(object):
+    """ limit: maximum number of open connections
+        limitPerHost: maximum number of open connections to a single host
+        dnsTtl: seconds for which DNS results are cached
+        timeout: default total timeout for a request, in seconds
+    """
+
+    def __init__(self, limit, limitPerHost, dnsTtl, timeout):
+        self.limit = limit
+        self.limitPerHost = limitPerHost
+        self.dnsTtl = dnsTtl
+        self.timeout = timeout
+        self.session = None
+        self.requests = 0
+        self.errors = 0
+
+
+    def getSession(self):
+        """ The session is created on first use, since it must
+            be created while the event loop is running.
+        """
+        if self.session is None or self.session.closed:
+            connector = TCPConnector(limit=self.limit,
+                    limit_per_host=self.limitPerHost,
+                    ttl_dns_cache=self.dnsTtl)
+            self.session = ClientSession(connector=connector,
+                    timeout=ClientTimeout(total=self.timeout))
+        return self.session
+
+
+    async def request(self, method, url, timeout=None, **kwargs):
+        """ Make a request and return the response with its body already
+            read. Raises aiohttp.ClientError for HTTP errors, and
+            asyncio.TimeoutError if the request takes too long.
+        """
+        if timeout is not None:
+            kwargs['timeout'] = ClientTimeout(total=timeout)
+        self.requests += 1
+        try:
+            async with self.getSession().request(method, url, **kwargs) as response:
+                response.raise_for_status()
+                await response.read()
+                return response
+        except:
+            self.errors += 1
+            raise
+
+
+    async def getJson(self, url, params=None, headers=None, timeout=None):
+        response = await self.request("GET", url, params=params, headers=headers, timeout=timeout)
+        return await response.json()
+
+
+    async def getBytes(self, url, params=None, headers=None, timeout=None):
+        response = await self.request("GET", url, params=params, headers=headers, timeout=timeout)
+        return await response.read()
+
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+    def __repr__(self):
+        return "%d requests, %d errors" % (self.requests, self.errors)
@@ -11,6 +11,8 @@ Some variable naming conventions:
 """
 from .log import IRCLogger
 from .protocol import Protocol
+from .sendqueue import SendQueue, TokenBucket, utf8len
+from . import formatting
 from .command import *
 from . import settings
 import asyncio
@@ -40,6 +42,81 @@ class Channel(object):
         return self.channel
 
 
+class ReconnectSupervisor(object):
+    """ Reconnects to the server when the connection drops. The delay 
+        doubles with each failed attempt, up to maxDelay, and is jittered
+        so that a flapping network doesn't have us retrying in lockstep.
+    """
+
+    def __init__(self, bot, minDelay, maxDelay):
+        self.bot = bot
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        self.attempts = 0
+        self.handle = None
+        self.stopped = False
+
+
+    def getDelay(self):
+        delay = min(self.maxDelay, self.minDelay * (2 ** self.attempts))
+        return random.uniform(delay/2, delay)
+
+
+    def schedule(self):
+        """ Schedule the next connection attempt, unless one is already pending
+        """
+        if self.stopped or self.handle: return
+        delay = self.getDelay()
+        self.attempts += 1
+        logger.info("Reconnecting in %.1f seconds (attempt %d)" % (delay,self.attempts))
+        self.handle = self.bot.loop.call_later(delay, self.reconnect)
+
+
+    def reconnect(self):
+        self.handle = None
+        if not self.stopped:
+            self.bot.create_connection()
+
+
+    def connected(self):
+        """ Called once we are registered with the server
+        """
+        self.attempts = 0
+
+
+    def stop(self):
+        """ Don't reconnect anymore, we're quitting
+        """
+        self.stopped = True
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+
+
+class SmaugIRCConnection(irc3.IrcConnection):
+    """ irc3 reconnects 2 seconds after every lost connection. 
+        This leaves reconnecting to the ReconnectSupervisor instead.
+    """
+
+    def connection_lost(self, exc):
+        if self.closed: return
+        self.factory.log.critical('connection lost (%s): %r', id(self.transport), exc)
+        self.close()
+        self.factory.notify('connection_lost')
+
+
+class SmaugIrcBot(irc3.IrcBot):
+
+    def connection_made(self, f):
+        if f.cancelled() or f.exception():
+            # irc3 would retry every 3 seconds, forever
+            logger.error("Could not connect to the IRC server: %s" % 
+                    (None if f.cancelled() else f.exception()))
+            self.config.factory.reconnect.schedule()
+            return
+        super(SmaugIrcBot, self).connection_made(f)
+
+
 class SmaugIRCFactory(object):
 
     def __init__(self, cmd, nick, password, server, port, channelNames, quitMessages, logdir):
@@ -67,6 +144,7 @@ class SmaugIRCFactory(object):
             debug = True,
             verbose = True,
             raw = True,
+            connection = __name__ + ".SmaugIRCConnection",
             includes = [
                 'irc3.plugins.core',
                 'irc3.plugins.autojoins',
@@ -74,7 +152,10 @@ class SmaugIRCFactory(object):
                 __name__,  # this register MyPlugin
             ]
         )
-        self.bot = irc3.IrcBot.from_config(config)
+        self.bot = SmaugIrcBot.from_config(config)
+        self.reconnect = ReconnectSupervisor(self.bot, 
+                settings.IRC_RECONNECT_MIN_DELAY,
+                settings.IRC_RECONNECT_MAX_DELAY)
 
     def startBot(self):
         """ Open a connection to the IRC server and begin running
@@ -98,6 +179,14 @@ class SmaugIRC(Protocol):
         self.channelNames = self.factory.channelNames
         self.kicked = False
         self.channels = {}
+        # flood limits apply to the whole connection, so all the 
+        # per-target queues share a single bucket
+        self.sendBucket = TokenBucket(settings.IRC_FLOOD_RATE, settings.IRC_FLOOD_BURST)
+        # (target, PRIVMSG|NOTICE) -> SendQueue
+        self.sendQueues = {}
+        # membership index: nick -> set of channels, handle -> set of nicks
+        self.nickChannels = {}
+        self.handleNicks = {}
         # channel for private messages
         lnick = self.nick.lower()
         self.channels[lnick] = Channel(lnick, self, self.factory.logdir)
@@ -114,12 +203,29 @@ class SmaugIRC(Protocol):
         """ We are connected.. 
         """
         logger.info("Connection made.")
+        self.factory.reconnect.connected()
         self.cmd.registerProtocol(self)
         close_db()
 
 
+    def connection_lost(self, client=None):
+        """ Called by irc3 when the connection drops. Channel membership
+            is kept, and compared with the WHO results once we're back, so
+            that only the people who actually came or went in the meantime
+            produce events.
+        """
+        logger.info("Connection lost.")
+        if self.factory.reconnect.stopped:
+            # we're quitting, connectionLost takes care of it
+            return
+        for channel in self.channels:
+            self.getLog(channel).disconnect()
+        self.factory.reconnect.schedule()
+
+
     async def die(self):
         logger.info("Quitting IRC")
+        self.factory.reconnect.stop()
         messages = list(self.factory.quitMessages)
         random.shuffle(messages)
         # TODO: technically, quit should return a future so it could be awaited here
@@ -130,17 +236,16 @@ class SmaugIRC(Protocol):
 
 
     def connectionLost(self):
-        """ Connection to the server was lost.
+        """ Connection to the server was lost for good.
         """
+        nicks = set()
         for channel in self.channels:
             self.getLog(channel).disconnect()
-            for name in self.channels[channel].names:
-                nickhost = name +"!"+ self.channels[channel].names[name]
-                user = self.getUser(nickhost)
-                if user:
-                    logger.info("Setting sign off for %s"%user)
-                    user.profile.sign_off = datetime.now()
-                    user.profile.save()
+            nicks.update(self.channels[channel].names.keys())
+        users = self.cmd.getUsersByHandles(nicks)
+        logger.info("Setting sign off for %d users"%len(users))
+        self.cmd.updateSignOff(users.values())
+        self.cmd.presence.disconnected(self.proto)
         self.close()
 
 
@@ -181,9 +286,8 @@ class SmaugIRC(Protocol):
         # Issue a who command on the channel
         results = await self.bot.who(channel)
         if results['success']:
-            for result in results['users']:
-                nickhost = str(result['mask'])
-                await self.userWho(nickhost, channel)
+            nickhosts = [str(result['mask']) for result in results['users']]
+            await self.usersWho(nickhosts, channel)
         else:
             logger.error("WHO command failed")
 
@@ -198,11 +302,39 @@ class SmaugIRC(Protocol):
         channel = channel.lower()
         nick,userhost = nickhost.split("!",1)
         logger.info("User who result for %s: %s" % (nick,userhost))
-        self.channels[channel].names[nick] = userhost
+        self.addName(channel, nick, userhost)
         await self.userSeenEntering(nickhost, channel)
         close_db()
 
 
+    async def usersWho(self, nickhosts, channel):
+        """ Process all the results of a WHO on a channel at once.
+            If we already know who is on the channel (i.e. we are back 
+            after a reconnect), only the differences are processed.
+        """
+        channel = channel.lower()
+        logger.info("Processing %d who results for %s" % (len(nickhosts),channel))
+        names = self.getChannel(channel).names
+        current = {}
+        for nickhost in nickhosts:
+            nick,userhost = nickhost.split("!",1)
+            current[nick] = userhost
+
+        arrived = [nick+"!"+current[nick] for nick in current if nick not in names]
+        departed = [nick+"!"+names[nick] for nick in names if nick not in current]
+
+        for nickhost in departed:
+            self.removeName(channel, nickhost.split("!")[0])
+        for nick in current:
+            self.addName(channel, nick, current[nick])
+
+        if departed:
+            logger.info("%d users left %s while we were away" % (len(departed),channel))
+            await self.usersSeenLeaving(departed, channel)
+        await self.usersSeenEntering(arrived, channel)
+        close_db()
+
+
     @irc3.event(irc3.rfc.KICK)
     def on_kick(self, mask, channel, target, **kwargs):
         kickerNick,kickerUserhost = mask.split("!",1)
@@ -222,7 +354,7 @@ class SmaugIRC(Protocol):
     def userKicked(self, kickee, channel, kicker, message):
         channel = channel.lower()
         nick = kickee.split("!")[0]
-        del self.channels[channel].names[nick]
+        self.removeName(channel, nick)
         self.getLog(channel).kick(kickee, kicker, message)             
         #TODO: implement
         #self.whois(kickee).addCallback(self.processKick, channel, kickee, message)
@@ -232,7 +364,7 @@ class SmaugIRC(Protocol):
         nickhost = str(mask)
         channel = channel.lower()
         nick = nickhost.split("!")[0]
-        del self.channels[channel].names[nick]
+        self.removeName(channel, nick)
         self.getLog(channel).part(nick, channel)
         await self.userSeenLeaving(nickhost, channel)
         close_db()
@@ -245,9 +377,8 @@ class SmaugIRC(Protocol):
         nick = nickhost.split("!")[0]
         channels = self.getUserChannels(nick)
         for channel in channels:
-            if nick in self.channels[channel].names:
-                del self.channels[channel].names[nick]
-                self.getLog(channel).quit(nick, message)
+            self.removeName(channel, nick)
+            self.getLog(channel).quit(nick, message)
             await self.userSeenLeaving(nickhost, channel, message)
         close_db()
 
@@ -260,17 +391,21 @@ class SmaugIRC(Protocol):
         newnickhost = newnick+"!"+host
         channels = self.getUserChannels(oldnick)
         
-        oldhandle = oldnick.split("|",1)
-        newhandle = newnick.split("|",1)
+        oldhandle = self.getHandle(oldnick)
+        newhandle = self.getHandle(newnick)
         
         for channel in channels:
-            del self.channels[channel].names[oldnick]
-            self.channels[channel].names[newnick] = host
+            self.removeName(channel, oldnick)
+            self.addName(channel, newnick, host)
             self.getLog(channel).nick(oldnick, newnick)
 
             if oldhandle != newhandle:
                 await self.userSeenLeaving(oldnickhost, channel)
                 await self.userSeenEntering(newnickhost, channel)
+
+        if oldhandle == newhandle:
+            # the same user under another alias, so there are no events
+            self.cmd.presence.renamed(self.proto, oldnick, newnick)
  
 
     #TODO: implement
@@ -415,8 +550,7 @@ class SmaugIRC(Protocol):
             await self.cmd.notifyListeners(context, "hear", message)
 
         if authed and channel:
-            user.profile.last_comment = datetime.now()
-            user.profile.save()
+            self.cmd.presence.heard(context)
  
 
     async def userSeenEntering(self, nickhost, channel, *message):
@@ -424,33 +558,66 @@ class SmaugIRC(Protocol):
             This could happen thru a variety of ways, which are 
             protocol specific.
         """
-        nick = nickhost.split("!")[0]
-        user = self.getUser(nickhost) 
-        if not user: return
-        user.profile.sign_on = datetime.now()
-        user.profile.save()
-        c = CommandContext(self, channel, user, nick, time.time())
-        if user == self.cmd.me:
-            await self.cmd.notifyListeners(c, "enter", message)
-        else:
-            await self.cmd.notifyListeners(c, "hearEnter", message)
+        await self.usersSeenEntering([nickhost], channel, *message)
+
+
+    async def usersSeenEntering(self, nickhosts, channel, *message):
+        """ userSeenEntering for many users. The users are resolved with 
+            one query, their sign on times are saved with one UPDATE, 
+            and the listeners are notified concurrently, in batches.
+        """
+        nicks = [nickhost.split("!")[0] for nickhost in nickhosts]
+        users = self.cmd.getUsersByHandles(nicks)
+        if not users: return
+
+        now = time.time()
+        entered = []
+        heardEntering = []
+        for nick in nicks:
+            user = users.get(self.cmd.normalizeHandle(nick))
+            if not user: continue
+            c = CommandContext(self, channel, user, nick, now)
+            if user == self.cmd.me:
+                entered.append(c)
+            else:
+                heardEntering.append(c)
+
+        self.cmd.updateSignOn(users.values())
+        await self.cmd.notifyListenersBatch(entered, "enter", message)
+        await self.cmd.notifyListenersBatch(heardEntering, "hearEnter", message)
 
 
     async def userSeenLeaving(self, nickhost, channel, *message):
         """ This Smaug event happens when a user disappears for
             some reason.
         """
-        nick = nickhost.split("!")[0]
-        if not(self.wasLastAlias(nick, channel)): return
-        user = self.getUser(nickhost) 
-        if not user: return
-        user.profile.sign_off = datetime.now()
-        user.profile.save()
-        c = CommandContext(self, channel, user, nick, time.time())
-        if user == self.cmd.me:
-            await self.cmd.notifyListeners(c, "exit", message)
-        else:
-            await self.cmd.notifyListeners(c, "hearExit", message)
+        await self.usersSeenLeaving([nickhost], channel, *message)
+
+
+    async def usersSeenLeaving(self, nickhosts, channel, *message):
+        """ userSeenLeaving for many users, see usersSeenEntering.
+            Users who still have another alias on the channel are skipped.
+        """
+        nicks = [nickhost.split("!")[0] for nickhost in nickhosts]
+        nicks = [nick for nick in nicks if self.wasLastAlias(nick, channel)]
+        users = self.cmd.getUsersByHandles(nicks)
+        if not users: return
+
+        now = time.time()
+        exited = []
+        heardExiting = []
+        for nick in nicks:
+            user = users.get(self.cmd.normalizeHandle(nick))
+            if not user: continue
+            c = CommandContext(self, channel, user, nick, now)
+            if user == self.cmd.me:
+                exited.append(c)
+            else:
+                heardExiting.append(c)
+
+        self.cmd.updateSignOff(users.values())
+        await self.cmd.notifyListenersBatch(exited, "exit", message)
+        await self.cmd.notifyListenersBatch(heardExiting, "hearExit", message)
 
 
     def getUser(self, nickhost):
@@ -524,52 +691,66 @@ class SmaugIRC(Protocol):
 
 
     async def sendNotification(self, where, content, em=None):
-        """ Implements protocol
+        """ Implements protocol. Returns once the content has been sent.
         """
-        f = None
-        if isinstance(content, str):
-            f = await self.sendNotificationLine(where, content)
-        elif isinstance(content, collections.Iterable):
-            for line in content:
-                f = await self.sendNotificationLine(where, line)
-        else:
-            raise Exception("Content is not string or iterable")
-        return f
+        await self.queueContent(where, content, "NOTICE")
 
        
-    async def sendNotificationLine(self, where, line):
-        if where.startswith("#"):
-            self.getLog(where).publicNotice(self.nick, where, line)
-        else:
-            self.getLog(self.nick.lower()).privateMessage(self.nick, line)
-            
-        self.bot.notice(where, line)
-
-
     async def sendMessage(self, where, content, em=None):
-        """ Implements protocol
+        """ Implements protocol. Returns once the content has been sent.
         """
-        f = None
+        await self.queueContent(where, content, "PRIVMSG")
+
+
+    async def queueContent(self, where, content, kind):
         if isinstance(content, str):
-            f = await self.sendLine(where, content)
+            lines = [content]
         elif isinstance(content, collections.Iterable):
-            for line in content:
-                f = await self.sendLine(where, line)
+            lines = content
         else:
             raise Exception("Content is not string or iterable")
-        return f
-       
 
-    async def sendLine(self, where, line):
-        if where.startswith("#"):
-            self.getLog(where).publicMessage(self.nick, line)
-        else:
-            self.getLog(self.nick.lower()).privateMessage(self.nick, line)
+        sq = self.getSendQueue(where, kind)
+        futures = []
+        for line in lines:
+            if kind == "PRIVMSG":
+                # collapse adjacent end/start color tags
+                line = formatting.normalizeIrc(line)
+            futures.append(sq.put(line))
+        if futures:
+            await asyncio.gather(*futures)
+
+
+    def getSendQueue(self, where, kind):
+        """ Returns the outbound queue for messages or notices to a target.
+            Lines are split on word boundaries so that each one fits in 
+            max_length bytes once encoded.
+        """
+        key = (where.lower(), kind)
+        sq = self.sendQueues.get(key)
+        if not sq:
+            sq = SendQueue(key, self.sendLine, self.sendBucket, 
+                    self.bot.config.max_length, measure=utf8len)
+            self.sendQueues[key] = sq
+        return sq
 
-        # collapse adjacent end/start color tags
-        line = re.sub(r"\x03(\s*?)\x03", "\x03", line)
 
-        return self.bot.privmsg(where, line)
+    async def sendLine(self, destination, line, extra=None):
+        """ Called by the send queues to put a single line on the wire.
+        """
+        where, kind = destination
+        if kind == "NOTICE":
+            if where.startswith("#"):
+                self.getLog(where).publicNotice(self.nick, where, line)
+            else:
+                self.getLog(self.nick.lower()).privateMessage(self.nick, line)
+            self.bot.notice(where, line)
+        else:
+            if where.startswith("#"):
+                self.getLog(where).publicMessage(self.nick, line)
+            else:
+                self.getLog(self.nick.lower()).privateMessage(self.nick, line)
+            self.bot.privmsg(where, line)
 
 
     # Commands
@@ -619,10 +800,10 @@ class SmaugIRC(Protocol):
     async def doSay(self, c, args):
         if not args: raise CmdParamError
         if c.channel:
-            await self.bot.privmsg(c.channel, args)
+            await self.sendMessage(c.channel, args)
         else:
-            for channel in self.channels:
-                await self.bot.privmsg(channel, args)
+            for channel in self.channelNames:
+                await self.sendMessage(channel, args)
 
 
     @command("notice")
@@ -635,7 +816,18 @@ class SmaugIRC(Protocol):
             who,message = args.split(" ",1)
         except:
             raise CmdParamError
-        await self.bot.notice(who, message)
+        await self.sendNotification(who, message)
+
+
+    @command("sendq")
+    @level(20)
+    @usage("!sendq")
+    @desc("Show the outbound message queues and their latency.")
+    async def showSendQueues(self, c, args):
+        content = ["Send queues:"]
+        for sq in self.sendQueues.values():
+            content.append("  %s" % sq)
+        await c.reply(content)
 
 
     @command("version")
@@ -687,28 +879,55 @@ class SmaugIRC(Protocol):
         return self.getChannel(channelName).log
  
 
+    def getHandle(self, nick):
+        """ The part of the nick which identifies the user
+        """
+        return nick.split("|",1)[0].lower()
+
+
+    def addName(self, channelName, nick, userhost):
+        """ Record that a nick is on a channel
+        """
+        channelName = channelName.lower()
+        self.getChannel(channelName).names[nick] = userhost
+        self.nickChannels.setdefault(nick, set()).add(channelName)
+        self.handleNicks.setdefault(self.getHandle(nick), set()).add(nick)
+
+
+    def removeName(self, channelName, nick):
+        """ Record that a nick is no longer on a channel
+        """
+        channelName = channelName.lower()
+        self.getChannel(channelName).names.pop(nick, None)
+        channels = self.nickChannels.get(nick)
+        if channels is None: return
+        channels.discard(channelName)
+        if not channels:
+            # the nick is gone from every channel
+            del self.nickChannels[nick]
+            handle = self.getHandle(nick)
+            nicks = self.handleNicks.get(handle)
+            if nicks is not None:
+                nicks.discard(nick)
+                if not nicks: del self.handleNicks[handle]
+
+
     def getUserChannels(self, nick):
         """ Return a list of channels a user is on
         """ 
-        channels = []
-        for channelName in self.channels:
-            for name in self.channels[channelName].names:
-                if name == nick:
-                    channels.append(channelName)
-                    
-        return channels
+        return list(self.nickChannels.get(nick, ()))
 
 
     def wasLastAlias(self, nick, channelName):
         """ Checks if this alias is the user's last
-            in the specified channel
+            in the specified channel, i.e. no other nick 
+            with the same handle is still there.
         """ 
-        nh = nick.split("|",1)
-        for name in self.channels[channelName].names:
-            h = nick.split("|",1)
-            if nh == h: return True
-        
-        return False
+        names = self.getChannel(channelName).names
+        for other in self.handleNicks.get(self.getHandle(nick), ()):
+            if other != nick and other in names: 
+                return False
+        return True
 
 
     def formatSender(self, nick):
@@ -722,38 +941,14 @@ class SmaugIRC(Protocol):
         """
         if not s: return None
 
-        colorCodes = {
-            'white'    : '00',
-            'black'    : '01',
-            'navy'     : '02',
-            'green'    : '03',
-            'red'      : '04',
-            'maroon'   : '05',
-            'purple'   : '06',
-            'orange'   : '07',
-            'yellow'   : '08',
-            'lime'     : '09',
-            'teal'     : '10',
-            'aqua'     : '11',
-            'blue'     : '12',
-            'fuchsia'  : '13',
-            'gray'     : '14',
-            'silver'   : '15',
-        }
-
-        hexCodes = {
-            'bold'     : 0x02,
-            'color'    : 0x03,
-            'reverse'  : 0x16,
-            'underline': 0x1f,
-        }
-
         for k in list(attrib.keys()):
-            if k in hexCodes:
-                code = chr(hexCodes[k])
+            if k == 'color':
                 value = attrib[k]
-                if value in colorCodes: value = colorCodes[value]
-                s = code + str(value) + s + code
+                value = formatting.IRC_COLOR_CODES.get(value, value)
+                s = formatting.IRC_COLOR + str(value) + s + formatting.IRC_COLOR
+            elif k in formatting.IRC_TOGGLES:
+                code = formatting.IRC_TOGGLES[k]
+                s = code + s + code
 
         return s
 
@@ -95,8 +95,7 @@ class Logger(object):
                 user=user,
                 year=stamp.year,
                 month=stamp.month,
-                external_id=external_id,
-                edited='N')
+                external_id=external_id)
         logline.save()
 
 
@@ -198,35 +197,17 @@ class DiscordLogger(Logger):
 
     def editLine(self,body,external_id):
         try:
-            # get message history
-            lines = models.LogLine.objects.filter(external_id__exact=external_id)
             # log to file
             self.log("(Edit Previous) %s" % body)
-
-            # mark the last version of the LogLine as edited
-            lastLine = list(lines)[-1]
-            lastLine.edited = 'Y'
-            lastLine.save()
-
-            # add a new LogLine for the edit
-            self._addLine(body,
-                    handle=lastLine.handle,
-                    user=lastLine.user,
-                    external_id=external_id)
-
+            # the LogLine keeps the current version, the old one goes to history
+            models.LogLine.objects.editLine(external_id, body)
         except:
             logger.exception("Error editing Discord log")
 
     
     def deleteLine(self,external_id):
         try:
-            # get message history
-            lines = models.LogLine.objects.filter(external_id__exact=external_id)
-            # mark all versions as deleted
-            for line in lines:
-                line.deleted = 'Y'
-                line.save()
-
+            models.LogLine.objects.deleteLine(external_id)
         except:
             logger.exception("Error deleting line from Discord log")
 
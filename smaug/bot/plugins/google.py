@@ -2,15 +2,21 @@
 Interface to Google search through a Custom Search
 """
 
-from apiclient.discovery import build
-
 from smaug.bot import settings
 from smaug.bot.command import *
 
+from aiohttp import ClientError
+from functools import partial
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
 class Google(Plugin):
     
     def __init__(self):
-        self.service = build("customsearch", "v1", developerKey=settings.GOOGLE_DEVELOPER_KEY)
+        # normalized query -> future for the request in flight
+        self.inflight = {}
 
 
     @command("google")
@@ -21,12 +27,18 @@ class Google(Plugin):
 
         if not(args.strip()): raise CmdParamError
             
-        res = self.service.cse().list(q=args,cx=settings.GOOGLE_CUSTOM_SEARCH_CX,num=1).execute()
+        try:
+            res = await self.getResults(c.protocol.cmd, args.strip())
+        except asyncio.TimeoutError:
+            raise CmdExeError("Google timed out")
+        except ClientError as e:
+            logger.warning("Google search failed: %s" % e)
+            raise CmdExeError("Google not responding")
 
-        if not res or not('items' in res) or len(res['items'])<1:
+        if not res:
             raise CmdExeError("Google not responding")
 
-        if not('items' in res):
+        if not('items' in res) or len(res['items'])<1:
             await c.reply("No hits")
             return
    
@@ -46,6 +58,32 @@ class Google(Plugin):
             c.protocol.format(title, color='lime')))
 
 
+    async def getResults(self, bot, query):
+        """ Run the search, sharing the request with any identical 
+            search which is already in flight. Results are cached. 
+        """
+        key = " ".join(query.lower().split())
+        future = self.inflight.get(key)
+        if future is None:
+            fetcher = partial(self.fetchResults, bot.http, query)
+            future = asyncio.ensure_future(bot.cache.fetch("google", key, fetcher))
+            self.inflight[key] = future
+            future.add_done_callback(lambda f: self.inflight.pop(key, None))
+        # shielded, so that one caller giving up doesn't cancel the others
+        return await asyncio.shield(future)
+
+
+    async def fetchResults(self, http, query):
+        params = {
+            'key': settings.GOOGLE_DEVELOPER_KEY,
+            'cx': settings.GOOGLE_CUSTOM_SEARCH_CX,
+            'q': query,
+            'num': 1,
+        }
+        return await http.getJson(settings.GOOGLE_SEARCH_URL, params=params,
+                timeout=settings.GOOGLE_SEARCH_TIMEOUT)
+
+
     def formatHtml(self, c, html):
         html = html.replace("&amp;",'&')
         html = html.replace("&lt;",'<')
@@ -47,9 +47,9 @@ class Logs(Plugin):
         if author:
             q = q.filter(user=author)
         q = q.exclude(user__name=self.bot_name)
+        q = q.exclude(body__startswith='!logs ')
 
-        filtered = [line for line in q if not(line.body.startswith('!logs '))]
-        count = len(filtered)
+        count = q.count()
 
         url = "%s/search/?searchText=%s"%(self.base_url,searchText)
         if author:
@@ -57,8 +57,9 @@ class Logs(Plugin):
 
         content.append("%d hits; %s"%(count,c.protocol.format(url,color='fuchsia')))
         if count>0:
+            # fetch just the one line, by offset
             r = random.randint(0, count-1)        
-            rline = filtered[r]
+            rline = q.select_related('user__profile')[r]
             cl = "<%s> %s"%(rline.handle,rline.body)
             if rline.user:
                 cl = c.protocol.format(cl,color=rline.user.profile.color)
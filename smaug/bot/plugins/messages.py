@@ -5,12 +5,25 @@ User messages
 from smaug.bot.command import *
 from smaug.ircview import models
 
+from django.db.models import Count
 from datetime import datetime
 
 class Messages(Plugin):
 
     def __init__(self):
-        self.users = {}
+        # user id -> number of unseen messages, and of unpassed messages
+        self.unseen = None
+        self.unpassed = None
+
+
+    def loadCounts(self):
+        """ Load the unseen and unpassed message counts for all users,
+            which are then kept up to date as messages are sent and read.
+        """
+        if self.unseen is not None: return
+        q = models.Message.objects.values_list('to_user').annotate(n=Count('id'))
+        self.unseen = dict(q.filter(seen='N'))
+        self.unpassed = dict(q.filter(passed='N'))
 
 
     @listen("enter")
@@ -23,21 +36,9 @@ class Messages(Plugin):
 
     @listen("hearEnter")
     async def hearEnter(self, c, message=""):
-        if c.user.id not in self.users:
-            self.users[c.user.id] = {}
-        # only the last handle to sign on will get notifications, 
-        # but this shouldn't be a problem since most people only
-        # have one handle per protocol online at a time
-        self.users[c.user.id][c.protocol.proto] = c
         await self.checkMessages(c, "")
 
 
-    @listen("hearExit")
-    async def hearExit(self, c, message=""):
-        if c.user.id in self.users:
-            if c.protocol.proto in self.users[c.user.id]:
-                del self.users[c.user.id][c.protocol.proto]
-
     @command("send")
     @level(2)
     @usage("!send <nick>,<nick>,... <message>")
@@ -66,17 +67,19 @@ class Messages(Plugin):
                            seen='N', passed='N', stamp=datetime.now())
         m.save()
 
+        self.loadCounts()
+        self.unseen[to_user.id] = self.unseen.get(to_user.id, 0) + 1
+        self.unpassed[to_user.id] = self.unpassed.get(to_user.id, 0) + 1
+
         await c.reply("Message sent to %s."%nick)
 
         # now notify the recipient if they are online
 
-        if to_user.id in self.users:
-            for k in list(self.users[to_user.id].keys()):
-                protocol = c.protocol.cmd.getProtocol(k)
-                tc = self.users[to_user.id][k]
-                if c.channel != tc.channel:
-                    await tc.reply("New message for %s." \
-                        % tc.user.name)
+        contexts = c.protocol.cmd.presence.getContexts(to_user.id)
+        for tc in list(contexts.values()):
+            if c.channel != tc.channel:
+                await tc.reply("New message for %s." \
+                    % tc.user.name)
 
 
     @command("read")
@@ -90,43 +93,46 @@ class Messages(Plugin):
         except ValueError:
             i = 10
 
-        j = 0
-        
-        messages = models.Message.objects.filter(to_user=c.user, seen='N').order_by('stamp')
+        self.loadCounts()
+        unseen = self.unseen.get(c.user.id, 0)
         content = []
 
-        if not messages: 
+        if not unseen: 
             content.append("No unread messages.")
         
         else:
+            messages = models.Message.objects.filter(to_user=c.user, seen='N') \
+                    .select_related('from_user').order_by('stamp')
+            if i > 0:
+                messages = messages[:i]
+            messages = list(messages)
+
             for m in messages:
                 when = m.stamp.strftime("%m/%d/%y %H:%M")
                 when = c.protocol.format(when, color='gray')
+                content.append("%s [%s]: %s" % (m.from_user.username,when,m.body))
 
-                m.seen = 'Y'
-                m.passed = 'Y'
-                m.save()
+            models.Message.objects.filter(id__in=[m.id for m in messages]) \
+                    .update(seen='Y', passed='Y')
 
-                content.append("%s [%s]: %s" % (m.from_user.username,when,m.body))
-                j += 1
-                if not i-j: break
+            passed = len([m for m in messages if m.passed == 'N'])
+            self.unseen[c.user.id] = max(0, unseen - len(messages))
+            self.unpassed[c.user.id] = max(0, self.unpassed.get(c.user.id, 0) - passed)
 
-            content.append("%s messages left." % (len(messages) - j))
+            content.append("%s messages left." % self.unseen[c.user.id])
 
         await c.reply(content)
 
 
     async def checkMessages(self, c, args):
 
-        messages = models.Message.objects.filter(to_user=c.user, passed='N')
-        if not messages: return
+        self.loadCounts()
+        if not self.unpassed.get(c.user.id): return
 
-        for m in messages:
-            m.passed = 'Y'
-            m.save()
+        models.Message.objects.filter(to_user=c.user, passed='N').update(passed='Y')
+        self.unpassed[c.user.id] = 0
 
-        messages = models.Message.objects.filter(to_user=c.user, seen='N')
-        num = messages.count()
+        num = self.unseen.get(c.user.id, 0)
 
         if num == 0:
             # Message was already seen but not marked passed. This shouldn't happen, but if it does, we just cleaned it up, so no big deal.
@@ -1,71 +1,92 @@
 """
 Polling functions
+
+Polls are stored in the database, along with a running count of the votes
+for each answer, so they survive restarts and the tally is never recounted.
+Polls close after a while, and are deleted some time after closing.
 """
 
+from smaug.bot import settings
 from smaug.bot.command import *
+from smaug.ircview import models
+
+from datetime import datetime, timedelta
 
-ANSWERS = {
-    0: 'No',
-    1: 'Yes',
-}
+DEFAULT_ANSWERS = ('Yes', 'No')
 
 class Poll(Plugin):
 
     def __init__(self):
-        self.polls = {}
-        self.nextPollId = 1
+        pass
 
     @command("poll")
     @level(20)
-    @usage("!poll <question>")
-    @desc("Construct a new poll.")
+    @usage("!poll [-m] <question> [| <answer> | <answer> ...]")
+    @desc("Construct a new poll. The answers default to yes and no. With -m, people may vote for more than one answer.")
     async def newPoll(self, c, args):
 
-        try:
-            question = args.strip()
-        except ValueError:
+        question = args.strip()
+        multiple = False
+        if question.startswith("-m "):
+            multiple = True
+            question = question[3:].strip()
+
+        parts = [p.strip() for p in question.split("|")]
+        question = parts[0]
+        answers = [p for p in parts[1:] if p] or DEFAULT_ANSWERS
+        if not question or len(answers) < 2:
             raise CmdParamError
 
-        pid = self.nextPollId
-        self.nextPollId += 1
-        self.polls[pid] = {
-            'q' : question,    
-            'votes': {},
-        }
+        self.expirePolls()
+
+        now = datetime.now()
+        poll = models.Poll(question=question, author=c.user, multiple=multiple,
+                created=now, closes=now+timedelta(hours=settings.POLL_DURATION))
+        poll.save()
+        models.PollAnswer.objects.bulk_create([models.PollAnswer(poll=poll, number=i+1, text=answer[:255]) \
+                for i, answer in enumerate(answers)])
 
-        await c.reply("Poll %d started: %s Type !vote %d <yes/no> to vote."%(pid,question,pid))
+        choices = ", ".join(["%d. %s" % (i+1, answer) for i, answer in enumerate(answers)])
+        if multiple:
+            how = "Type !vote %d <answer>,<answer>,... to vote." % poll.id
+        else:
+            how = "Type !vote %d <answer> to vote." % poll.id
+        await c.reply("Poll %d started: %s (%s) %s" % (poll.id, question, choices, how))
 
 
     @command("vote")
     @level(2)
-    @usage("!vote <poll id> [answer id]")
-    @desc("Vote on the given poll.")   
+    @usage("!vote <poll id> <answer>[,<answer>...]")
+    @desc("Vote on the given poll. Answers may be given by number or by name.")
     async def vote(self, c, args):
- 
+
         try:
-            poll,answer = args.split(" ",1)
+            poll, choices = args.split(" ",1)
             pid = int(poll)
-            answer = answer.strip().lower()
-            if answer == 'yes':
-                aid = 1
-            elif answer == 'no':
-                aid = 0
-            else:
-                await c.reply("Answer must be 'yes' or 'no'.")
-                return
         except ValueError:
-            raise CmdParamError       
+            raise CmdParamError
 
-        if pid not in self.polls:
-            await c.reply("There is no such poll.")
-            return
+        poll = self.getPoll(pid)
+        if not poll.is_open():
+            raise CmdExeError("That poll is closed.")
+
+        answers = list(poll.answers.all())
+        chosen = []
+        for choice in choices.split(","):
+            answer = findAnswer(answers, choice.strip().lower())
+            if not answer:
+                raise CmdExeError("Answer must be one of: %s" % ", ".join([a.text for a in answers]))
+            if answer not in chosen:
+                chosen.append(answer)
 
-        if c.user.id in self.polls[pid]['votes']:
+        if len(chosen) > 1 and not poll.multiple:
+            raise CmdExeError("You may only choose one answer in this poll.")
+
+        if not models.Poll.objects.vote(poll, c.user, chosen):
             await c.reply("You have already voted in this poll.")
             return
 
-        self.polls[pid]['votes'][c.user.id] = aid
-        await c.reply("In the poll '%s', you voted %s."%(self.polls[pid]['q'],ANSWERS[aid]))
+        await c.reply("In the poll '%s', you voted %s." % (poll.question, ", ".join([a.text for a in chosen])))
 
 
     @command("tally")
@@ -73,32 +94,67 @@ class Poll(Plugin):
     @usage("!tally <poll id>")
     @desc("Show the current tally for a poll.")
     async def showTally(self, c, args):
-        
+
         try:
             pid = int(args)
         except ValueError:
             raise CmdParamError
- 
-        if pid not in self.polls:
-            await c.reply("There is no such poll.")
-            return
 
-        votes = self.polls[pid]['votes']
-
-        tally = {}
-        
-        for userId in list(votes.keys()):
-            vote = votes[userId]
-            if vote in tally:
-                tally[vote] += 1
-            else:
-                tally[vote] = 1
-        
-        content = ["Poll: %s"%self.polls[pid]['q']]
-        
-        for vote in list(tally.keys()):
-            content.append("%s: %d votes" % (ANSWERS[vote],tally[vote]))
+        poll = self.getPoll(pid)
+        state = "open" if poll.is_open() else "closed"
+        content = ["Poll: %s (%s, %d voters)" % (poll.question, state, poll.voters)]
+        for answer in poll.answers.all():
+            content.append("%s: %d votes" % (answer.text, answer.votes))
+
+        await c.reply(content)
+
 
+    @command("polls")
+    @level(2)
+    @usage("!polls")
+    @desc("List the open polls.")
+    async def listPolls(self, c, args):
+
+        polls = models.Poll.objects.filter(closes__gt=datetime.now()).order_by('id')
+        content = ["%d: %s" % (poll.id, poll.question) for poll in polls]
+        if not content:
+            content.append("There are no open polls.")
         await c.reply(content)
 
 
+    @command("endpoll")
+    @level(20)
+    @usage("!endpoll <poll id>")
+    @desc("Close a poll to further votes.")
+    async def endPoll(self, c, args):
+
+        try:
+            pid = int(args)
+        except ValueError:
+            raise CmdParamError
+
+        poll = self.getPoll(pid)
+        if not poll.is_open():
+            raise CmdExeError("That poll is already closed.")
+
+        models.Poll.objects.filter(id=poll.id).update(closes=datetime.now())
+        await c.reply("Poll %d closed. Use !tally %d to see the results." % (pid, pid))
+
+
+    def getPoll(self, pid):
+        try:
+            return models.Poll.objects.get(id=pid)
+        except models.Poll.DoesNotExist:
+            raise CmdExeError("There is no such poll.")
+
+
+    def expirePolls(self):
+        before = datetime.now() - timedelta(days=settings.POLL_EXPIRY)
+        models.Poll.objects.expire(before)
+
+
+def findAnswer(answers, choice):
+    for answer in answers:
+        if choice == str(answer.number) or choice == answer.text.lower():
+            return answer
+    return None
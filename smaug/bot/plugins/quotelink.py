@@ -2,21 +2,110 @@
 Linking to quotes
 """
 
+from smaug.bot import settings
 from smaug.bot.command import *
 from smaug.ircview import models
 
-from aiohttp import ClientSession
 from discord import Embed
 from bs4 import BeautifulSoup
+from django.db.models.signals import post_save, post_delete
+from functools import partial
 import logging
 import re
+import time
 
 logger = logging.getLogger(__name__)
 
+# Identifies the index's signal handlers
+DISPATCH_UID = "quotelink-index"
+
+
+def normalize(terms):
+    text = terms.lower().strip()
+    text = re.sub(r'[^a-zA-Z0-9 ]+?','', text)
+    text = re.sub(r'\s+?',' ', text)
+    return text.strip()
+
+
+class QuoteIndex(object):
+    """ In-memory index for finding the quotes whose match_text contains 
+        a given piece of normalized text, without hitting the database. 
+
+        Each quote's lowercased text is split on spaces, and every pair of
+        adjacent words is posted to the quotes containing it. Any word of 
+        the search text other than the first and last must appear whole in 
+        a matching quote, so the quotes containing all of those interior 
+        pairs are the only candidates, and each is then verified with a 
+        plain substring test.
+    """
+
+    def __init__(self, maxAge):
+        self.maxAge = maxAge
+        self.quotes = {}
+        self.postings = {}
+        self.stamp = 0
+        self.dirty = True
+
+
+    def invalidate(self, **kwargs):
+        self.dirty = True
+
+
+    def rebuild(self):
+        quotes = {}
+        postings = {}
+        for quote in models.QuoteLink.objects.all():
+            text = (quote.match_text or "").lower()
+            quotes[quote.id] = (quote, text)
+            words = text.split(" ")
+            for pair in zip(words, words[1:]):
+                postings.setdefault(pair, set()).add(quote.id)
+        self.quotes = quotes
+        self.postings = postings
+        self.stamp = time.time()
+        self.dirty = False
+        logger.info("Indexed %d quotes (%d word pairs)" % (len(quotes), len(postings)))
+
+
+    def search(self, text, limit=None):
+        """ Returns the quotes whose match_text contains the given text,
+            which should already be normalized, in id order.
+        """
+        if self.dirty or time.time() - self.stamp > self.maxAge:
+            self.rebuild()
+
+        words = text.split(" ")[1:-1]
+        candidates = None
+        for pair in set(zip(words, words[1:])):
+            ids = self.postings.get(pair)
+            if not ids: return []
+            candidates = set(ids) if candidates is None else candidates & ids
+            if not candidates: return []
+
+        if candidates is None:
+            # too short to use the index
+            candidates = self.quotes.keys()
+
+        matches = []
+        for quoteId in sorted(candidates):
+            quote, quoteText = self.quotes[quoteId]
+            if text in quoteText:
+                matches.append(quote)
+                if limit and len(matches) >= limit: break
+        return matches
+
+
 class QuoteLink(Plugin):
 
     def __init__(self):
-        pass
+        self.index = QuoteIndex(settings.QUOTE_INDEX_REFRESH)
+        # pick up changes made by this process right away; changes made 
+        # elsewhere (e.g. the admin site) are seen when the index expires.
+        # A reloaded plugin replaces the previous instance's handlers.
+        for signal in (post_save, post_delete):
+            signal.disconnect(sender=models.QuoteLink, dispatch_uid=DISPATCH_UID)
+            signal.connect(self.index.invalidate, sender=models.QuoteLink, 
+                    weak=False, dispatch_uid=DISPATCH_UID)
 
     @listen("hear")
     async def hear(self, c, line):
@@ -32,7 +121,9 @@ class QuoteLink(Plugin):
                 content.append("%s (%s)\n" % (quote.url, quote.title))
                 embed = None
                 try:
-                    img_url = await self.getComicImageUrl(quote.url)
+                    bot = c.protocol.cmd
+                    fetcher = partial(self.getComicImageUrl, bot.http, quote.url)
+                    img_url = await bot.cache.fetch("comic", quote.url, fetcher)
                     if img_url:
                         embed = Embed()
                         embed.set_image(url=img_url)
@@ -41,14 +132,11 @@ class QuoteLink(Plugin):
                 await c.reply(content, em=embed)
 
 
-    async def getComicImageUrl(self, url):
+    async def getComicImageUrl(self, http, url):
         # Needed for PA, otherwise it returns a 403
         headers = {"User-Agent":"Mozilla/5.0 (Macintosh; Intel Mac OS X 10.12; rv:56.0) Gecko/20100101 Firefox/56.0"}
 
-        html = None
-        async with ClientSession(headers=headers) as session:
-            async with session.get(url) as response:
-                html = await response.read()
+        html = await http.getBytes(url, headers=headers)
 
         if html:
             soup = BeautifulSoup(html.decode('utf-8'), 'html.parser')
@@ -82,14 +170,10 @@ class QuoteLink(Plugin):
 
 
     def searchDb(self, terms, fetchLimit=3, matchLimit=None, exact=False):
-        text = terms.lower().strip()
-        text = re.sub(r'[^a-zA-Z0-9 ]+?','', text)
-        text = re.sub(r'\s+?',' ', text)
-        text = text.strip()
+        text = normalize(terms)
         if exact:
-            quotes = models.QuoteLink.objects.filter(match_text__icontains=text)
-        else:
-            quotes = models.QuoteLink.objects.filter(match_text__search=text)
+            return self.index.search(text, limit=fetchLimit)
+        quotes = models.QuoteLink.objects.filter(match_text__search=text)
         return list(quotes[:fetchLimit])
 
 
@@ -4,7 +4,8 @@ Rock Paper Scissors
 A simple version of rock paper scissors. A duel can be started in a channel using !rps and then the !throw's 
 should come in private messages. All the output will go to the channel the game was started in.
 
-Uses the database for tracking game statistics in the rps table.
+Uses the database for tracking game statistics in the rps table. A summary
+of each player's record is kept up to date as games are saved.
 """
 
 from smaug.bot.command import *
@@ -287,8 +288,75 @@ class RPS(Plugin):
 
             r = models.RpsGame(winner=winnar, winner_play=winnerGambit, winner_time=winnerMap['time'],
                     loser=loser, loser_play=loserGambit, loser_time=loserMap['time'], rounds=self.rps['games_played'])
-            r.save()
+            models.RpsStats.objects.record(r)
 
             # reset the game
             self.rps = {}
-            
+
+
+    @command("rpsstats")
+    @level(2)
+    @usage("!rpsstats [nick]")
+    @desc("Show someone's Rock Paper Scissors record. Defaults to your own.")
+    async def showStats(self, c, args):
+
+        nick = args.strip()
+        user = c.protocol.cmd.getUserByHandle(nick) if nick else c.user
+        if not user:
+            raise CmdExeError("Unknown user.")
+
+        stats = models.RpsStats.objects.filter(user=user).first()
+        if not stats:
+            await c.reply("%s has not played any matches." % user.name)
+            return
+
+        played = stats.wins + stats.losses
+        if stats.streak > 0:
+            streak = "won the last %d" % stats.streak
+        else:
+            streak = "lost the last %d" % -stats.streak
+
+        content = ["%s: %d wins, %d losses (%d%%), %s, best streak %d, worst streak %d" % \
+            (user.name, stats.wins, stats.losses, 100*stats.wins/played, streak, 
+            stats.best_streak, stats.worst_streak)]
+
+        throw, count = stats.get_favourite_throw()
+        favourites = "Favourite throw: %s (%d times)" % (throw, count)
+        gambit = user.rps_gambits.filter(gambit__in=list(self.gambits.keys())).order_by('-count').first()
+        if gambit:
+            favourites += ", favourite gambit: %s (%d times)" % (self.gambits[gambit.gambit], gambit.count)
+        content.append(favourites)
+
+        await c.reply(content)
+
+
+    @command("rpstop")
+    @level(2)
+    @usage("!rpstop [num]")
+    @desc("Show the players with the most Rock Paper Scissors wins (default 5).")
+    async def showTop(self, c, args):
+
+        try:
+            num = max(1, min(int(args.strip()), 20))
+        except ValueError:
+            num = 5
+
+        top = models.RpsStats.objects.select_related('user').order_by('-wins','losses')[:num]
+        content = []
+        for i, stats in enumerate(top):
+            content.append("%d. %s: %d-%d, best streak %d" % \
+                (i+1, stats.user.name, stats.wins, stats.losses, stats.best_streak))
+        if not content:
+            content.append("No matches have been played.")
+
+        await c.reply(content)
+
+
+    @command("rpsrebuild")
+    @level(50)
+    @usage("!rpsrebuild")
+    @desc("Rebuild the Rock Paper Scissors statistics from the history of games.")
+    async def rebuildStats(self, c, args):
+        players = models.RpsStats.objects.rebuild()
+        await c.reply("Rebuilt statistics for %d players." % players)
+
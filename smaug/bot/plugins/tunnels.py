@@ -3,18 +3,43 @@ Inter-Protocol Tunnels (IPTs) are used for user communication across
 protocols. A user opens tunnels to whoever they want and then everything
 they type is transmitted to all the listening parties. Both sides
 have the ability to close a tunnel.
+
+Bridges are for mirroring busy channels: everything said in either 
+channel is queued and relayed to the other in batches.
 """
 
 from smaug.bot.command import *
+from smaug.bot import formatting
 
+from django.core.exceptions import ObjectDoesNotExist
+from collections import deque
+import asyncio
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+# Seconds for which user colors are cached
+COLOR_CACHE_AGE = 60*30
+
+# Lines waiting to cross a bridge before the oldest are dropped,
+# which bounds the lag when a channel is busier than the protocol allows
+BRIDGE_MAX_PENDING = 200
+# Maximum number of lines relayed in one batch
+BRIDGE_MAX_BATCH = 20
+# Seconds during which a line containing one we relayed is an echo
+BRIDGE_ECHO_WINDOW = 30
+
 class Tunnels(Plugin):
 
     def __init__(self):
+        # routing table: each tunnel is indexed by the key of its fromParty
         self.tunnels = {}
+        # user id -> profile color, for senders in tunneled channels
+        self.colors = {}
+        self.colorsStamp = time.time()
+        # (proto, channel) -> bridges with an end in that channel
+        self.bridges = {}
  
        
     @listen("hear")
@@ -23,30 +48,29 @@ class Tunnels(Plugin):
             thru which to transmit this message.
         """
         # check the sender's open tunnels
-        tunnels = self.getTunnels(c.user, c.protocol) 
-        if tunnels:
-            for tunnel in tunnels:
-                await tunnel.printLine(line)
-
-                # check for a chunnel :o
-                # I mean, this tunnel might go into a channel which 
-                # has outgoing tunnels that need to be written
-                to = tunnel.toParty
-                if to.channel:
-                    chunnels = self.getTunnels(None, to.protocol)
-                    for chunnel in chunnels:
-                        if (chunnel.fromParty.channel == to.channel) and \
-                                not(chunnel.toParty == tunnel.fromParty):
-                            fc = CommandContext(c.protocol, chunnel.fromParty.channel,
-                                c.user, c.alias, None)
-                            await chunnel.printChannelLine(fc,line)
+        for tunnel in list(self.getTunnels(getSenderKey(c))):
+            await tunnel.printLine(line)
+
+            # check for a chunnel :o
+            # I mean, this tunnel might go into a channel which 
+            # has outgoing tunnels that need to be written
+            to = tunnel.toParty
+            if to.channel:
+                for chunnel in list(self.getTunnels(to.getKey())):
+                    if not(chunnel.toParty == tunnel.fromParty):
+                        fc = CommandContext(c.protocol, chunnel.fromParty.channel,
+                            c.user, c.alias, None)
+                        await chunnel.printChannelLine(fc, line, self.getColor(c.user))
 
         # also check for channel tunnels
-        tunnels = self.getTunnels(None, c.protocol)
-        if tunnels:
-            for tunnel in tunnels:
-                if c.channel == tunnel.fromParty.channel:
-                    await tunnel.printChannelLine(c,line)
+        if c.channel:
+            key = (c.protocol.proto, "channel", c.channel)
+            for tunnel in list(self.getTunnels(key)):
+                await tunnel.printChannelLine(c, line, self.getColor(c.user))
+
+            # bridges only queue the line, so they never hold up the listener
+            for bridge in self.bridges.get((c.protocol.proto, c.channel), []):
+                bridge.relay(c, line, self.getColor(c.user))
 
 
     @listen("hearExit")
@@ -54,7 +78,7 @@ class Tunnels(Plugin):
         """ Listen for users signing off, 
             so that tunnels can be cleaned up.
         """
-        tunnels = self.getTunnels(c.user, c.protocol)
+        tunnels = self.getTunnels(getSenderKey(c))
         if tunnels:
             # close the sender's open tunnels
             toDelete = tunnels[:]
@@ -71,7 +95,7 @@ class Tunnels(Plugin):
     async def listTunnels(self, c, args):
 
         fromParty = self.getFromParty(c)
-        tunnels = self.getTunnels(fromParty.user, fromParty.protocol)
+        tunnels = self.getTunnels(fromParty.getKey())
 
         content = []
         if not tunnels:
@@ -91,9 +115,8 @@ class Tunnels(Plugin):
     async def listAllTunnels(self, c, args):
 
         tunnels = []
-        for user in self.tunnels:
-            for proto in self.tunnels[user]:
-                tunnels += self.tunnels[user][proto]
+        for key in self.tunnels:
+            tunnels += self.tunnels[key]
 
         content = []
         if not tunnels:
@@ -176,14 +199,12 @@ class Tunnels(Plugin):
 
         # establish tunnel
         ipt = IPT(fromParty, toParty)
-        tunnels = self.getTunnels(fromParty.user, fromParty.protocol)
-        tunnels.append(ipt)
+        self.addTunnel(ipt)
         logger.info("Established tunnel: %s" % ipt)
         
         # reverse tunnel
         ript = IPT(toParty, fromParty)
-        rtunnels = self.getTunnels(toParty.user, toParty.protocol)
-        rtunnels.append(ript)
+        self.addTunnel(ript)
         logger.info("Established tunnel: %s" % ript)
 
         # mmm, circular references
@@ -210,7 +231,7 @@ class Tunnels(Plugin):
             closeAll = 1
 
         fromParty = self.getFromParty(c)
-        tunnels = self.getTunnels(fromParty.user, fromParty.protocol)
+        tunnels = self.getTunnels(fromParty.getKey())
 
         toDelete = []
         for tunnel in tunnels:
@@ -234,37 +255,160 @@ class Tunnels(Plugin):
         """
         rtunnel = tunnel.getReverse()
 
-        user = tunnel.fromParty.user
-        ruser = rtunnel.fromParty.user
-        proto = tunnel.fromParty.protocol.proto
-        rproto = rtunnel.fromParty.protocol.proto
-
         logger.info("Closing tunnel: %s" % tunnel)
-        self.tunnels[user][proto].remove(tunnel)
+        self.removeTunnel(tunnel)
 
         logger.info("Closing tunnel: %s" % rtunnel)
-        self.tunnels[ruser][rproto].remove(rtunnel)
+        self.removeTunnel(rtunnel)
 
 
-    def getTunnels(self, user, protocol):
-        """ Get a list of tunnels for a user on a protocol
-        """
+    @command("bridge")
+    @level(10)
+    @usage("!bridge <proto:#channel>")
+    @desc("Bridges the current channel to a channel on another protocol.")
+    async def openBridge(self, c, args):
+
+        try:
+            tproto, target = args.strip().split(":",1)
+        except ValueError:
+            raise CmdParamError
+
+        if not str(c.channel).startswith("#"):
+            raise CmdExeError("Bridges must be opened from a channel")
+
+        if not(tproto in c.protocol.cmd.protocols and target.startswith("#")):
+            raise CmdExeError("Cannot resolve channel/protocol")
 
-        if user:
-            uid = user.id
+        targetProtocol = c.protocol.cmd.getProtocol(tproto)
+        if target not in targetProtocol.channels:
+            raise CmdExeError("Channel %s does not exist on protocol %s"%(target,tproto))
+
+        if (tproto, target) == (c.protocol.proto, c.channel):
+            raise CmdExeError("Cannot bridge a channel to itself")
+
+        if self.getBridge(c.protocol.proto, c.channel, tproto, target):
+            raise CmdExeError("Already bridged to %s:%s" % (tproto,target))
+
+        bridge = Bridge(BridgeEnd(c.protocol, c.channel), BridgeEnd(targetProtocol, target))
+        for end in bridge.ends:
+            self.bridges.setdefault(end.getKey(), []).append(bridge)
+        logger.info("Opened bridge: %s" % bridge)
+
+        openMessage = "Bridge open to %s. Use !unbridge to close it."
+        await bridge.ends[0].protocol.sendMessage(bridge.ends[0].channel, openMessage % bridge.ends[1])
+        await bridge.ends[1].protocol.sendMessage(bridge.ends[1].channel, openMessage % bridge.ends[0])
+
+
+    @command("unbridge")
+    @level(10)
+    @usage("!unbridge [proto:#channel]")
+    @desc("Closes the current channel's bridge to the given channel, or all of its bridges.")
+    async def closeBridge(self, c, args):
+
+        key = (c.protocol.proto, c.channel)
+        bridges = list(self.bridges.get(key, []))
+        if args.strip():
+            try:
+                tproto, target = args.strip().split(":",1)
+            except ValueError:
+                raise CmdParamError
+            bridges = [b for b in bridges if b.getOtherEnd(key).getKey() == (tproto, target)]
+
+        if not bridges:
+            raise CmdExeError("No matching bridges")
+
+        closeMessage = "Closed bridge to %s"
+        for bridge in bridges:
+            logger.info("Closing bridge: %s" % bridge)
+            bridge.close()
+            for end in bridge.ends:
+                self.bridges[end.getKey()].remove(bridge)
+                if not self.bridges[end.getKey()]:
+                    del self.bridges[end.getKey()]
+            a, b = bridge.ends
+            await a.protocol.sendMessage(a.channel, closeMessage % b)
+            await b.protocol.sendMessage(b.channel, closeMessage % a)
+
+
+    @command("bridges")
+    @level(2)
+    @usage("!bridges")
+    @desc("Lists all open bridges, with their lag and throughput.")
+    async def listBridges(self, c, args):
+
+        bridges = []
+        for key in self.bridges:
+            for bridge in self.bridges[key]:
+                if bridge not in bridges:
+                    bridges.append(bridge)
+
+        content = []
+        if not bridges:
+            content.append("No active bridges")
         else:
-            uid = "None"
+            content.append("%d active bridges:"%len(bridges))
+            for bridge in bridges:
+                for end in bridge.ends:
+                    content.append("  %r" % end)
+
+        await c.reply(content)
+
 
-        if user not in self.tunnels:
-            self.tunnels[user] = {}
+    def getBridge(self, proto, channel, tproto, target):
+        for bridge in self.bridges.get((proto, channel), []):
+            if bridge.getOtherEnd((proto, channel)).getKey() == (tproto, target):
+                return bridge
+        return None
 
-        proto = protocol.proto
-        if proto not in self.tunnels[user]:
-            self.tunnels[user][proto] = []
 
-        tunnels = self.tunnels[user][proto]
-        logger.debug("Got tunnels for user %s on %s: %s"%(user,proto,tunnels))
-        return tunnels
+    def addTunnel(self, tunnel):
+        key = tunnel.fromParty.getKey()
+        if key not in self.tunnels:
+            self.tunnels[key] = []
+        self.tunnels[key].append(tunnel)
+
+
+    def removeTunnel(self, tunnel):
+        key = tunnel.fromParty.getKey()
+        self.tunnels[key].remove(tunnel)
+        if not self.tunnels[key]:
+            del self.tunnels[key]
+
+
+    def getTunnels(self, key):
+        """ Get the list of tunnels leaving the party with the given key
+        """
+        return self.tunnels.get(key, [])
+
+
+    def getColor(self, user):
+        """ Returns the profile color for the given user, from the cache
+            if possible
+        """
+        if not user: return None
+        if time.time() - self.colorsStamp > COLOR_CACHE_AGE:
+            self.colors = {}
+            self.colorsStamp = time.time()
+        if user.id not in self.colors:
+            self.colors[user.id] = getProfileColor(user)
+        return self.colors[user.id]
+
+
+def getSenderKey(c):
+    """ Returns the routing key for the user who said something 
+        in the given context. 
+    """
+    if c.user:
+        return (c.protocol.proto, "user", c.user.id)
+    return (c.protocol.proto, "alias", c.alias)
+
+
+def getProfileColor(user):
+    if not user: return None
+    try:
+        return user.profile.color
+    except ObjectDoesNotExist:
+        return None
 
 
 
@@ -296,16 +440,17 @@ class IPT:
         """ Send a message thru the tunnel.
         """
         sender = self.fromParty.protocol.formatSender(self.fromParty.alias)
-        text = sender + self.toParty.protocol.format(line)
+        text = sender + formatting.translate(line, 
+                self.fromParty.protocol.proto, self.toParty.protocol.proto)
         
-        userColor = self.fromParty.user.profile.color
+        userColor = self.fromParty.color
         if userColor:
             text = self.toParty.protocol.format(text, color=userColor)
             
         await self.messageReceiver(text)
  
  
-    async def printChannelLine(self, c, line):
+    async def printChannelLine(self, c, line, userColor=None):
         """ 
         This is a special method for tunnels in which the fromParty 
         is a channel. It uses the given context to determine the 
@@ -315,9 +460,9 @@ class IPT:
             raise ValueError("context does not match IPT")
 
         sender = c.protocol.formatSender("%s:%s"%(c.channel,c.alias))
-        text = sender + self.toParty.protocol.format(line)
+        text = sender + formatting.translate(line, 
+                c.protocol.proto, self.toParty.protocol.proto)
         
-        userColor = c.user.profile.color
         if userColor:
             text = self.toParty.protocol.format(text, color=userColor)
         else:
@@ -362,12 +507,165 @@ class Party:
         self.user = user
         self.protocol = protocol
         self.channel = channel
+        self.color = getProfileColor(user)
 
 
     def getName(self):
         return self.alias or self.channel
 
 
+    def getKey(self):
+        """ Returns the key under which tunnels from this party are routed:
+            the user if there is one, otherwise the channel, or the alias
+            of a user who isn't known to the bot.
+        """
+        proto = self.protocol.proto
+        if self.user:
+            return (proto, "user", self.user.id)
+        if self.channel:
+            return (proto, "channel", self.channel)
+        return (proto, "alias", self.alias)
+
+
     def __repr__(self):
         return "%s:%s" % (self.protocol.proto, self.getName())
 
+
+class Bridge:
+    """ A pair of channels, on different protocols (or the same one), 
+        whose lines are mirrored to each other
+    """
+
+    def __init__(self, a, b):
+        self.ends = (a, b)
+
+
+    def getOtherEnd(self, key):
+        a, b = self.ends
+        return b if a.getKey() == key else a
+
+
+    def relay(self, c, line, userColor=None):
+        """ Queue a line heard in one of the channels for the other one
+        """
+        a, b = self.ends
+        if a.getKey() == (c.protocol.proto, c.channel):
+            source, target = a, b
+        else:
+            source, target = b, a
+
+        # a line which echoes one we relayed into this channel (for 
+        # example from another relay bot) is not sent back again
+        if source.isEcho(line):
+            source.echoes += 1
+            return
+
+        plain = "<%s> %s" % (c.alias, formatting.toPlain(line, source.protocol.proto))
+        text = target.protocol.formatSender(c.alias) + formatting.translate(line, 
+                source.protocol.proto, target.protocol.proto)
+        if userColor:
+            text = target.protocol.format(text, color=userColor)
+        target.put(text, plain)
+
+
+    def close(self):
+        for end in self.ends:
+            end.close()
+
+
+    def __repr__(self):
+        return "%s <-> %s" % self.ends
+
+
+class BridgeEnd:
+    """ One channel of a bridge, with the queue of lines being relayed 
+        into it and statistics about them
+    """
+
+    def __init__(self, protocol, channel):
+        self.protocol = protocol
+        self.channel = channel
+        self.pending = deque()
+        self.worker = None
+        # (time, plain text) of lines recently relayed into the channel
+        self.recent = deque()
+        self.started = time.time()
+        self.lines = 0
+        self.batches = 0
+        self.dropped = 0
+        self.echoes = 0
+        self.lastLag = 0
+        self.maxLag = 0
+        self.totalLag = 0
+
+
+    def getKey(self):
+        return (self.protocol.proto, self.channel)
+
+
+    def put(self, text, plain):
+        if len(self.pending) >= BRIDGE_MAX_PENDING:
+            self.pending.popleft()
+            self.dropped += 1
+        self.pending.append((time.time(), text, plain))
+        if not self.worker or self.worker.done():
+            self.worker = asyncio.ensure_future(self.run())
+
+
+    async def run(self):
+        """ Send everything which is pending, in batches. Lines queued while 
+            a batch is being sent go out together in the next batch, and the 
+            protocol's send queue packs them within its own limits.
+        """
+        while self.pending:
+            batch = []
+            while self.pending and len(batch) < BRIDGE_MAX_BATCH:
+                batch.append(self.pending.popleft())
+
+            now = time.time()
+            for stamp, text, plain in batch:
+                self.recent.append((now, plain))
+
+            try:
+                await self.protocol.sendMessage(self.channel, [text for stamp, text, plain in batch])
+            except Exception:
+                logger.exception("Error relaying to %s" % self)
+                continue
+
+            now = time.time()
+            for stamp, text, plain in batch:
+                lag = now - stamp
+                self.lastLag = lag
+                self.maxLag = max(self.maxLag, lag)
+                self.totalLag += lag
+            self.lines += len(batch)
+            self.batches += 1
+
+
+    def isEcho(self, line):
+        cutoff = time.time() - BRIDGE_ECHO_WINDOW
+        while self.recent and self.recent[0][0] < cutoff:
+            self.recent.popleft()
+        line = formatting.toPlain(line, self.protocol.proto)
+        for stamp, plain in self.recent:
+            if plain in line:
+                return True
+        return False
+
+
+    def close(self):
+        if self.worker and not self.worker.done():
+            self.worker.cancel()
+        self.pending.clear()
+
+
+    def __repr__(self):
+        minutes = max(1, time.time() - self.started) / 60
+        avgLag = self.totalLag / self.lines if self.lines else 0
+        return "-> %s: %d lines in %d batches (%.1f/min), %d pending, lag %.2fs (avg %.2fs, max %.2fs), %d dropped, %d echoes" % \
+            (self, self.lines, self.batches, self.lines/minutes, len(self.pending),
+            self.lastLag, avgLag, self.maxLag, self.dropped, self.echoes)
+
+
+    def __str__(self):
+        return "%s:%s" % (self.protocol.proto, self.channel)
@@ -2,24 +2,49 @@
 Utilities for dealing with URLS.
 """
 
+from smaug.bot import settings
 from smaug.bot.command import *
-
-import urllib.request
+from smaug.ircview import models
 from smaug.utils.urls import findUrls
 
+from collections import deque
+import asyncio
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
 MAX_URLS = 5
 
+# Seconds to wait after a change before saving the history snapshot
+SAVE_DELAY = 60
+
 class Urls(Plugin):
 
     def __init__(self):
-        self.opener = urllib.request.build_opener()
-        self.urls = []
+        # (proto, channel) -> deque of the most recent URLs
+        self.urls = {}
+        self.saveHandle = None
+        # don't overwrite a snapshot we couldn't read
+        self.loaded = False
+        self.loadHistory()
+
+
+    def unload(self):
+        """ Save any changes which are waiting for the timer
+        """
+        if self.saveHandle:
+            self.saveHandle.cancel()
+            self.saveHistory()
      
 
     @listen("hear")
     async def hear(self, c, line):
         urls = findUrls(line)
-        self.urls.extend(urls)
+        if urls:
+            self.getHistory(c).extend(urls)
+            self.scheduleSave()
         if c.protocol.proto=='irc':
             content = []
             for url in urls:
@@ -40,7 +65,10 @@ class Urls(Plugin):
             for url in urls:
                 content.append(self.createTinyUrl(url))
         else:
-            content.append(self.createTinyUrl(self.urls[-1]))
+            history = self.getHistory(c)
+            if not history:
+                raise CmdExeError("No URLs have been spoken here")
+            content.append(self.createTinyUrl(history[-1]))
 
         await c.reply(content)
 
@@ -57,22 +85,72 @@ class Urls(Plugin):
         except:    
             num = 3
 
-        if num > len(self.urls):
-            num = len(self.urls)
+        history = self.getHistory(c)
+
+        if num > len(history):
+            num = len(history)
 
         if num > MAX_URLS:
             num = MAX_URLS
 
-        start = len(self.urls) - num
+        start = len(history) - num
 
-        for i in range(start,len(self.urls)):
-            content.append(self.urls[i])
+        for i in range(start,len(history)):
+            content.append(history[i])
 
         await c.reply(content)
 
 
     def createTinyUrl(self, url):
-        req = urllib.request.Request('http://tinyurl.com/api-create.php?url='+url)
-        return "%s"%self.opener.open(req).read().decode("utf-8")
+        shorturl = models.ShortUrl.objects.shorten(url)
+        return "%s/u/%s" % (settings.WEB_BASE_URL, shorturl.code)
+
+
+    def getHistory(self, c):
+        """ Returns the URL history for the channel (or private 
+            conversation) of the given context.
+        """
+        key = (c.protocol.proto, c.channel or c.alias)
+        if key not in self.urls:
+            self.urls[key] = deque(maxlen=settings.URL_HISTORY_SIZE)
+        return self.urls[key]
 
 
+    def loadHistory(self):
+        filename = settings.URL_HISTORY_FILE
+        if not filename or not os.path.exists(filename): 
+            self.loaded = True
+            return
+        try:
+            with open(filename) as f:
+                snapshot = json.load(f)
+            for proto, channel, urls in snapshot:
+                self.urls[(proto, channel)] = deque(urls, maxlen=settings.URL_HISTORY_SIZE)
+            logger.info("Loaded URL history for %d channels" % len(self.urls))
+            self.loaded = True
+        except:
+            logger.exception("Error loading URL history from %s" % filename)
+
+
+    def scheduleSave(self):
+        if not settings.URL_HISTORY_FILE or self.saveHandle: return
+        loop = asyncio.get_event_loop()
+        self.saveHandle = loop.call_later(SAVE_DELAY, self.saveHistory)
+
+
+    def saveHistory(self):
+        """ Write a snapshot of the history, replacing the old one atomically
+        """
+        self.saveHandle = None
+        if not self.loaded:
+            logger.warning("Not saving URL history, since it could not be loaded")
+            return
+        filename = settings.URL_HISTORY_FILE
+        snapshot = [[proto, channel, list(urls)] for (proto, channel), urls in self.urls.items()]
+        try:
+            tmpname = filename + ".tmp"
+            with open(tmpname, "w") as f:
+                json.dump(snapshot, f, separators=(',',':'))
+            os.replace(tmpname, filename)
+        except:
+            logger.exception("Error saving URL history to %s" % filename)
@@ -330,11 +330,11 @@ class UserTools(Plugin):
         if not user: 
             raise CmdExeError("No such user: %s"%handle)
  
-        profile = user.profile
+        presence = c.protocol.cmd.presence.get(user)
         content = []
 
-        if profile.last_comment:
-            when = profile.last_comment.strftime("on %m/%d/%Y at %I:%M %p")
+        if presence.lastComment:
+            when = presence.lastComment.strftime("on %m/%d/%Y at %I:%M %p")
             content.append("I last heard from %s %s."%(user.name,when))  
         else:
             content.append("I have no idea when %s last spoke."%user.name)
@@ -354,16 +354,24 @@ class UserTools(Plugin):
         if not user: 
             raise CmdExeError("No such user: %s"%handle)
  
-        profile = user.profile
+        presence = c.protocol.cmd.presence.get(user)
         content = []
 
-        if profile.sign_off:
-            if profile.sign_on>profile.sign_off:
-                when = profile.sign_on.strftime("on %m/%d/%Y at %I:%M %p")
-                content.append("%s is here. They signed in %s."%(user.name,when))
-            else:
-                when = profile.sign_off.strftime("on %m/%d/%Y at %I:%M %p")
-                content.append("I last saw %s %s."%(user.name,when))  
+        if presence.isOnline():
+            where = []
+            for proto, alias, channels in presence.getAliases():
+                channels = sorted([ch for ch in channels if ch])
+                if channels:
+                    where.append("%s as %s in %s" % (proto, alias, ", ".join(channels)))
+                else:
+                    where.append("%s as %s" % (proto, alias))
+            content.append("%s is here (%s)."%(user.name,"; ".join(where)))
+            if presence.signOn:
+                when = presence.signOn.strftime("on %m/%d/%Y at %I:%M %p")
+                content.append("They signed in %s."%when)
+        elif presence.signOff:
+            when = presence.signOff.strftime("on %m/%d/%Y at %I:%M %p")
+            content.append("I last saw %s %s."%(user.name,when))  
         else:
             content.append("I haven't seen %s."%user.name)
 
@@ -2,23 +2,36 @@
 Interface to Youtube search 
 """
 
-from apiclient.discovery import build
-
 from smaug.bot import settings
+from smaug.bot.cache import MISS
 from smaug.bot.command import *
 from smaug.utils.urls import findUrls, findYoutubeIds
 
+from aiohttp import ClientError
+import asyncio
+from collections import OrderedDict
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The API accepts up to 50 ids per request
+MAX_IDS_PER_REQUEST = 50
+
 class Youtube(Plugin):
     
     def __init__(self):
-        self.service = build("youtube", "v3", developerKey=settings.GOOGLE_DEVELOPER_KEY)
+        # video id -> metadata (or None if the video does not exist)
+        self.cache = OrderedDict()
 
 
     @listen("hear")
     async def hear(self, c, line):
+        yids = []
         for url in findUrls(line):
             if 'youtube.com/watch' in url:
-                await self.showYoutubeUrlMetadata(c, url)
+                yids.extend(findYoutubeIds(url))
+        if yids:
+            await self.showYoutubeIdsMetadata(c, yids)
 
 
     @command("youtube")
@@ -28,29 +41,92 @@ class Youtube(Plugin):
     async def showYoutubeUrlMetadata(self, c, videoUrl):
         yids = findYoutubeIds(videoUrl)
         if not yids: return
-        for yid in yids:
-            await self.showYoutubeIdMetadata(c, yid)
+        await self.showYoutubeIdsMetadata(c, yids)
        
 
-    async def showYoutubeIdMetadata(self, c, videoId):
-        res = self.service.videos().list(id=videoId,part="snippet,statistics",\
-            fields="items(snippet(title,channelTitle),statistics)").execute()
-        if not res or (not 'items' in res) or len(res['items'])<1: return
-        result = res['items'][0]
-        author = c.protocol.format(result['snippet']['channelTitle'], color='gray')
-        
-        title = result['snippet']['title']
+    async def showYoutubeIdsMetadata(self, c, videoIds):
+        try:
+            metadata = await self.getMetadata(c.protocol.cmd, videoIds)
+        except (ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Youtube lookup failed: %s" % e)
+            return
+
+        content = []
+        for videoId in unique(videoIds):
+            result = metadata.get(videoId)
+            if not result: continue
+            author = c.protocol.format(result['snippet']['channelTitle'], color='gray')
+            
+            title = result['snippet']['title']
+
+            stats = result['statistics']
+
+            if ('likeCount' in stats) and ('dislikeCount' in stats):
+                likes = int(result['statistics']['likeCount'] or 0)
+                dislikes = int(result['statistics']['dislikeCount'] or 0)
+                likesStr = c.protocol.format("%d"%likes, color='lime')
+                dislikesStr = c.protocol.format("%d"%dislikes, color='red')
+                content.append("%s [%s] Likes:%s/%s" % (title,author,likesStr,dislikesStr))
+            else:
+                content.append("%s [%s]"  % (title,author))
+
+        if content:
+            await c.reply(content)
 
-        stats = result['statistics']
 
-        if ('likeCount' in stats) and ('dislikeCount' in stats):
-            likes = int(result['statistics']['likeCount'] or 0)
-            dislikes = int(result['statistics']['dislikeCount'] or 0)
-            likesStr = c.protocol.format("%d"%likes, color='lime')
-            dislikesStr = c.protocol.format("%d"%dislikes, color='red')
-            await c.reply("%s [%s] Likes:%s/%s" % (title,author,likesStr,dislikesStr))
-        else:
-            await c.reply("%s [%s]"  % (title,author))
+    async def getMetadata(self, bot, videoIds):
+        """ Returns a dict of video id to metadata for the given ids. 
+            Ids which were seen recently come from memory or the bot's 
+            response cache, and the rest are fetched together in as few 
+            requests as possible.
+        """
+        metadata = {}
+        missing = []
+        for videoId in unique(videoIds):
+            if videoId in self.cache:
+                self.cache.move_to_end(videoId)
+                metadata[videoId] = self.cache[videoId]
+                continue
+            result = bot.cache.get("youtube", videoId)
+            if result is MISS:
+                missing.append(videoId)
+            else:
+                metadata[videoId] = result
+                self.cacheMetadata(videoId, result)
+
+        for i in range(0, len(missing), MAX_IDS_PER_REQUEST):
+            batch = missing[i:i+MAX_IDS_PER_REQUEST]
+            items = await self.fetchMetadata(bot.http, batch)
+            for videoId in batch:
+                # cache misses too, so dead links aren't looked up again
+                metadata[videoId] = items.get(videoId)
+                self.cacheMetadata(videoId, metadata[videoId])
+                bot.cache.put("youtube", videoId, metadata[videoId])
+
+        return metadata
+
+
+    async def fetchMetadata(self, http, videoIds):
+        params = {
+            'key': settings.GOOGLE_DEVELOPER_KEY,
+            'id': ",".join(videoIds),
+            'part': "snippet,statistics",
+            'fields': "items(id,snippet(title,channelTitle),statistics)",
+        }
+        res = await http.getJson(settings.YOUTUBE_API_URL, params=params,
+                timeout=settings.YOUTUBE_API_TIMEOUT)
+        items = {}
+        if res and 'items' in res:
+            for item in res['items']:
+                items[item['id']] = item
+        return items
+
+
+    def cacheMetadata(self, videoId, metadata):
+        self.cache[videoId] = metadata
+        self.cache.move_to_end(videoId)
+        while len(self.cache) > settings.YOUTUBE_CACHE_SIZE:
+            self.cache.popitem(last=False)
 
 
     def formatHtml(self, c, html):
@@ -64,3 +140,10 @@ class Youtube(Plugin):
         html = p.sub(r"\1",html)
         return html
        
+
+def unique(seq):
+    """ The distinct items of seq, in order
+    """
+    seen = set()
+    return [x for x in seq if not (x in seen or seen.add(x))]
+
@@ -0,0 +1,225 @@
+"""
+Presence registry.
+
+Keeps track, in memory, of which users are online on which protocols,
+under which aliases and in which channels, and when they were last seen
+and heard. It is fed by the protocol events as they are dispatched, so
+commands and plugins can answer from memory. The times are also kept in
+each user's profile as a durable snapshot: the sign on and off times are
+saved by the protocols, and the times users last spoke are saved here,
+in batches.
+"""
+
+from smaug.bot.command import CommandContext
+from smaug.ircview import models
+
+from django.db.models import Case, When, Value, DateTimeField
+from datetime import datetime
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+ENTER_EVENTS = ('enter', 'hearEnter')
+EXIT_EVENTS = ('exit', 'hearExit')
+
+
+class UserPresence(object):
+    """ What we know about one user's presence
+    """
+
+    def __init__(self, user, signOn=None, signOff=None, lastComment=None):
+        self.user = user
+        self.signOn = signOn
+        self.signOff = signOff
+        self.lastComment = lastComment
+        # proto -> channel name (None if not in a channel) -> context 
+        # with the alias the user was last seen using there
+        self.channels = {}
+
+
+    def isOnline(self):
+        return any(self.channels.values())
+
+
+    def getContext(self, proto):
+        """ Returns the most recent context for reaching the user
+            on the given protocol, or None if they're not online there
+        """
+        contexts = self.channels.get(proto)
+        if not contexts: return None
+        return max(contexts.values(), key=lambda c: c.when)
+
+
+    def getAliases(self, proto=None):
+        """ Returns a list of (proto, alias, channels) for the user's
+            aliases which are online
+        """
+        aliases = {}
+        for p, contexts in self.channels.items():
+            if proto is not None and p != proto: continue
+            for channel, c in contexts.items():
+                aliases.setdefault((p, c.alias), set()).add(channel)
+        return [(p, alias, channels) for (p, alias), channels in sorted(aliases.items())]
+
+
+class PresenceRegistry(object):
+    """ flushInterval: seconds between saves of the last spoken times
+
+        Online state is kept per user, protocol and channel, whatever alias
+        the user is using, so an exit always clears the channel it's for.
+        The protocols still keep their own membership indexes, which cover
+        everyone (not just known users) and are needed to resolve nicks,
+        but they report every alias change here.
+    """
+
+    def __init__(self, flushInterval):
+        self.flushInterval = flushInterval
+        self.users = {}
+        # (proto, lowercase alias) -> user id, for the aliases online
+        self.aliases = {}
+        self.dirty = set()
+        self.flushHandle = None
+
+
+    def get(self, user):
+        """ Returns the UserPresence for the given user. The first time a
+            user is looked up, the times are loaded from their profile.
+        """
+        presence = self.users.get(user.id)
+        if presence is None:
+            try:
+                profile = user.profile
+                presence = UserPresence(user, profile.sign_on, profile.sign_off, profile.last_comment)
+            except models.SmaugUserProfile.DoesNotExist:
+                presence = UserPresence(user)
+            self.users[user.id] = presence
+        return presence
+
+
+    def getContexts(self, userId):
+        """ Returns a dict of protocol name to a context for reaching the
+            user on that protocol. Only protocols on which the user is
+            online are included.
+        """
+        presence = self.users.get(userId)
+        if presence is None: return {}
+        contexts = {}
+        for proto in presence.channels:
+            c = presence.getContext(proto)
+            if c: contexts[proto] = c
+        return contexts
+
+
+    def update(self, c, eventType, when=None):
+        """ Update the registry for an event about to be dispatched
+        """
+        if not c.user: return
+        if eventType in ENTER_EVENTS:
+            self.entered(c, when)
+        elif eventType in EXIT_EVENTS:
+            self.left(c, when)
+
+
+    def entered(self, c, when=None):
+        presence = self.get(c.user)
+        proto = c.protocol.proto
+        contexts = presence.channels.setdefault(proto, {})
+        previous = contexts.get(c.channel)
+        contexts[c.channel] = c
+        self.aliases[(proto, c.alias.lower())] = c.user.id
+        if previous:
+            self.dropAliases(presence, proto, [previous.alias])
+        presence.signOn = when or datetime.now()
+
+
+    def left(self, c, when=None):
+        """ The user left the channel in the given context, whichever
+            alias they were using there. Leaving without a channel 
+            (e.g. quitting) leaves every channel on the protocol.
+        """
+        presence = self.get(c.user)
+        proto = c.protocol.proto
+        contexts = presence.channels.get(proto, {})
+        if c.channel is None:
+            removed = list(contexts.values())
+            contexts.clear()
+        else:
+            # an entry without a channel stands for the whole protocol
+            removed = [contexts.pop(ch) for ch in (c.channel, None) if ch in contexts]
+        self.dropAliases(presence, proto, [c.alias] + [r.alias for r in removed])
+        presence.signOff = when or datetime.now()
+
+
+    def renamed(self, proto, oldAlias, newAlias):
+        """ A user changed their alias without leaving, e.g. from 
+            "krad" to "krad|away"
+        """
+        userId = self.aliases.get((proto, oldAlias.lower()))
+        presence = self.users.get(userId)
+        if presence is None: return
+        contexts = presence.channels.get(proto, {})
+        for channel, c in list(contexts.items()):
+            if c.alias.lower() == oldAlias.lower():
+                contexts[channel] = CommandContext(c.protocol, channel, c.user, newAlias, c.when)
+        self.aliases[(proto, newAlias.lower())] = userId
+        self.dropAliases(presence, proto, [oldAlias])
+
+
+    def dropAliases(self, presence, proto, aliases):
+        """ Remove the given aliases from the index, unless the 
+            user is still online with them somewhere
+        """
+        online = set([c.alias.lower() for c in presence.channels.get(proto, {}).values()])
+        for alias in aliases:
+            key = (proto, alias.lower())
+            if key[1] not in online and self.aliases.get(key) == presence.user.id:
+                del self.aliases[key]
+
+
+    def disconnected(self, proto, when=None):
+        """ The connection to the given protocol was lost,
+            so nobody is online there anymore
+        """
+        when = when or datetime.now()
+        for presence in self.users.values():
+            if presence.channels.pop(proto, None):
+                presence.signOff = when
+        for key in [key for key in self.aliases if key[0] == proto]:
+            del self.aliases[key]
+
+
+    def heard(self, c, when=None):
+        """ The user in the given context said something
+        """
+        if not c.user: return
+        self.get(c.user).lastComment = when or datetime.now()
+        self.dirty.add(c.user.id)
+        self.scheduleFlush()
+
+
+    def scheduleFlush(self):
+        if self.flushHandle: return
+        loop = asyncio.get_event_loop()
+        self.flushHandle = loop.call_later(self.flushInterval, self.flush)
+
+
+    def flush(self):
+        """ Save the last spoken times which changed since the last
+            flush, with a single UPDATE
+        """
+        self.flushHandle = None
+        if not self.dirty: return
+        times = [(userId, self.users[userId].lastComment) for userId in self.dirty]
+        self.dirty = set()
+        try:
+            models.SmaugUserProfile.objects.filter(user_id__in=[userId for userId, t in times]) \
+                .update(last_comment=Case(*[When(user_id=userId, then=Value(t)) for userId, t in times],
+                                          output_field=DateTimeField()))
+        except Exception:
+            logger.exception("Error saving last comment times")
+
+
+    def __repr__(self):
+        online = len([p for p in self.users.values() if p.isOnline()])
+        return "%d users known, %d online, %d unsaved" % (len(self.users), online, len(self.dirty))
@@ -0,0 +1,266 @@
+"""
+Outbound message queues.
+
+Lines bound for the same destination are queued, merged into as few
+messages as the protocol allows, split where they are too long, and
+paced with a token bucket so that bursts stay under the server's limits.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def utf8len(s):
+    """ Length of a string once it is encoded for the wire
+    """
+    return len(s.encode("utf-8"))
+
+
+def splitText(text, maxLength, measure=len):
+    """ Split text into chunks which measure no more than maxLength.
+        Every line of the text starts a new chunk. Long lines are broken
+        on spaces where possible, and between characters otherwise,
+        so multi-byte characters are never cut in half.
+    """
+    chunks = []
+    for line in text.split("\n"):
+        current = []
+        size = 0
+        for word in line.split(" "):
+            wsize = measure(word)
+            if current and size + 1 + wsize <= maxLength:
+                current.append(word)
+                size += 1 + wsize
+                continue
+            if current:
+                chunks.append(" ".join(current))
+                current = []
+                size = 0
+            if wsize <= maxLength:
+                current.append(word)
+                size = wsize
+            else:
+                # a single word which is too long by itself
+                piece = ""
+                psize = 0
+                for ch in word:
+                    csize = measure(ch)
+                    if psize + csize > maxLength:
+                        chunks.append(piece)
+                        piece = ""
+                        psize = 0
+                    piece += ch
+                    psize += csize
+                current.append(piece)
+                size = psize
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def packChunks(chunks, maxLength, measure=len, joiner="\n"):
+    """ Greedily join adjacent chunks into messages no longer than maxLength.
+        Each chunk must already fit by itself.
+    """
+    messages = []
+    current = None
+    size = 0
+    jsize = measure(joiner)
+    for chunk in chunks:
+        csize = measure(chunk)
+        if current is not None and size + jsize + csize <= maxLength:
+            current += joiner + chunk
+            size += jsize + csize
+        else:
+            if current is not None:
+                messages.append(current)
+            current = chunk
+            size = csize
+    if current is not None:
+        messages.append(current)
+    return messages
+
+
+class TokenBucket(object):
+    """ Hands out up to `burst` tokens at once, refilling at `rate`
+        tokens per second. One token is needed for each message sent.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.blockedUntil = 0
+
+
+    def delay(self):
+        """ Seconds until the next token is available
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now-self.stamp)*self.rate)
+        self.stamp = now
+        wait = max(0, self.blockedUntil - now)
+        if self.tokens < 1:
+            wait = max(wait, (1-self.tokens) / self.rate)
+        return wait
+
+
+    async def take(self):
+        """ Wait for a token and consume it
+        """
+        wait = self.delay()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.delay()
+        self.tokens -= 1
+
+
+    def block(self, seconds):
+        """ Hand out no tokens for the given number of seconds,
+            e.g. because the server told us to back off.
+        """
+        self.blockedUntil = max(self.blockedUntil, time.monotonic()+seconds)
+        self.tokens = 0
+
+
+QueueEntry = collections.namedtuple('QueueEntry', ['text','extra','future','stamp'])
+
+
+class SendQueue(object):
+    """ Outbound queue for a single destination (channel or user).
+
+        destination: protocol specific target, passed through to send()
+        send: coroutine function called as send(destination, text, extra)
+        bucket: TokenBucket pacing the sends. It may be shared between queues.
+        maxLength: maximum size of a single message, according to measure()
+        joiner: string used to merge adjacent lines into one message, or
+            None if the protocol needs one message per line
+        retryAfter: function which, given an exception raised by send(),
+            returns the number of seconds to wait before retrying, or None
+            if the send should not be retried.
+    """
+
+    MAX_RETRIES = 3
+
+    def __init__(self, destination, send, bucket, maxLength,
+            measure=len, joiner=None, retryAfter=None):
+        self.destination = destination
+        self.send = send
+        self.bucket = bucket
+        self.maxLength = maxLength
+        self.measure = measure
+        self.joiner = joiner
+        self.retryAfter = retryAfter
+        self.pending = collections.deque()
+        self.worker = None
+        # statistics
+        self.lines = 0
+        self.messages = 0
+        self.lastLatency = 0
+        self.maxLatency = 0
+        self.totalLatency = 0
+
+
+    def put(self, text, extra=None):
+        """ Queue some text for delivery. Returns a future which is
+            resolved once all of the text has been sent.
+        """
+        future = asyncio.Future()
+        self.pending.append(QueueEntry(text, extra, future, time.monotonic()))
+        if not self.worker or self.worker.done():
+            self.worker = asyncio.ensure_future(self.run())
+        return future
+
+
+    def takeBatch(self):
+        """ Take as many entries off the queue as can be merged together.
+            An entry with extras (e.g. an embed) ends the batch, because
+            the extras go along with its last message.
+        """
+        batch = []
+        while self.pending:
+            entry = self.pending.popleft()
+            batch.append(entry)
+            if entry.extra is not None or self.joiner is None:
+                break
+        return batch
+
+
+    def getMessages(self, batch):
+        chunks = []
+        for entry in batch:
+            chunks.extend(splitText(entry.text, self.maxLength, self.measure))
+        if self.joiner is None:
+            return [c for c in chunks if c]
+        return packChunks(chunks, self.maxLength, self.measure, self.joiner)
+
+
+    async def run(self):
+        while self.pending:
+            batch = self.takeBatch()
+            messages = self.getMessages(batch)
+            extra = batch[-1].extra
+            try:
+                if not messages and extra is not None:
+                    messages = [""]
+                for i, message in enumerate(messages):
+                    last = i == len(messages)-1
+                    await self.deliver(message, extra if last else None)
+            except Exception as e:
+                logger.exception("Error sending to %s" % self.destination)
+                for entry in batch:
+                    if not entry.future.done():
+                        entry.future.set_exception(e)
+                continue
+
+            now = time.monotonic()
+            for entry in batch:
+                latency = now - entry.stamp
+                self.lastLatency = latency
+                self.maxLatency = max(self.maxLatency, latency)
+                self.totalLatency += latency
+                self.lines += 1
+                if not entry.future.done():
+                    entry.future.set_result(True)
+
+
+    async def deliver(self, message, extra):
+        attempt = 0
+        while True:
+            await self.bucket.take()
+            try:
+                await self.send(self.destination, message, extra)
+                self.messages += 1
+                return
+            except Exception as e:
+                attempt += 1
+                wait = self.retryAfter(e) if self.retryAfter else None
+                if wait is None or attempt > self.MAX_RETRIES:
+                    raise
+                logger.warning("Rate limited sending to %s, waiting %.2fs" % (self.destination,wait))
+                self.bucket.block(wait)
+
+
+    def getStats(self):
+        """ Returns a dict of queue statistics. Latencies are in seconds
+            and measure the time from put() until the text was sent.
+        """
+        return {
+            'pending': len(self.pending),
+            'lines': self.lines,
+            'messages': self.messages,
+            'last_latency': self.lastLatency,
+            'max_latency': self.maxLatency,
+            'avg_latency': self.totalLatency / self.lines if self.lines else 0,
+        }
+
+
+    def __repr__(self):
+        stats = self.getStats()
+        return "%s: %d pending, %d lines in %d messages, latency %.2fs (avg %.2fs, max %.2fs)" % \
+            (self.destination, stats['pending'], stats['lines'], stats['messages'],
+            stats['last_latency'], stats['avg_latency'], stats['max_latency'])
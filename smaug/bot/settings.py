@@ -22,20 +22,66 @@ IRC_CHANNELS = settings_module.IRC_CHANNELS
 IRC_QUIT_MESSAGES = settings_module.IRC_QUIT_MESSAGES
 IRC_LOGDIR = settings_module.IRC_LOGDIR
 IRC_MODULES = settings_module.IRC_MODULES
+# Outbound lines per second, and burst size, for the IRC connection
+IRC_FLOOD_RATE = getattr(settings_module, "IRC_FLOOD_RATE", 0.5)
+IRC_FLOOD_BURST = getattr(settings_module, "IRC_FLOOD_BURST", 5)
+# Seconds to wait before reconnecting, doubling after each failure
+IRC_RECONNECT_MIN_DELAY = getattr(settings_module, "IRC_RECONNECT_MIN_DELAY", 2)
+IRC_RECONNECT_MAX_DELAY = getattr(settings_module, "IRC_RECONNECT_MAX_DELAY", 300)
 
 DISCORD_TOKEN = settings_module.DISCORD_TOKEN
 DISCORD_SERVER_NAME = settings_module.DISCORD_SERVER_NAME
+# Optional, otherwise the id is looked up by DISCORD_SERVER_NAME
+DISCORD_SERVER_ID = getattr(settings_module, "DISCORD_SERVER_ID", None)
 DISCORD_CHANNELS = settings_module.DISCORD_CHANNELS
 DISCORD_LOGDIR = settings_module.DISCORD_LOGDIR
 DISCORD_MODULES = settings_module.DISCORD_MODULES
 DISCORD_ALERTS = settings_module.DISCORD_ALERTS
+# Outbound messages per second, and burst size, for each Discord channel
+DISCORD_SEND_RATE = getattr(settings_module, "DISCORD_SEND_RATE", 1.0)
+DISCORD_SEND_BURST = getattr(settings_module, "DISCORD_SEND_BURST", 5)
+# Seconds a member must stay offline before they are considered gone
+DISCORD_PRESENCE_DEBOUNCE = getattr(settings_module, "DISCORD_PRESENCE_DEBOUNCE", 30)
 
 ACCESS_NEEDS_AUTH = settings_module.ACCESS_NEEDS_AUTH
 
 WEB_BASE_URL = settings_module.WEB_BASE_URL
 
+# Shared HTTP client used by plugins
+HTTP_POOL_SIZE = getattr(settings_module, "HTTP_POOL_SIZE", 20)
+HTTP_POOL_SIZE_PER_HOST = getattr(settings_module, "HTTP_POOL_SIZE_PER_HOST", 4)
+HTTP_DNS_CACHE_TTL = getattr(settings_module, "HTTP_DNS_CACHE_TTL", 300)
+HTTP_TIMEOUT = getattr(settings_module, "HTTP_TIMEOUT", 15)
+
+# Persistent cache for responses from external services
+RESPONSE_CACHE_FILE = getattr(settings_module, "RESPONSE_CACHE_FILE", ":memory:")
+RESPONSE_CACHE_SIZE = getattr(settings_module, "RESPONSE_CACHE_SIZE", 10000)
+RESPONSE_CACHE_TTLS = getattr(settings_module, "RESPONSE_CACHE_TTLS", 
+        { 'google': 60*60*24, 'youtube': 60*60*6, 'comic': 60*60*24*30 })
+RESPONSE_CACHE_DEFAULT_TTL = getattr(settings_module, "RESPONSE_CACHE_DEFAULT_TTL", 60*60)
+RESPONSE_CACHE_NEGATIVE_TTL = getattr(settings_module, "RESPONSE_CACHE_NEGATIVE_TTL", 60*10)
+
+# Seconds between saves of the times users last spoke
+PRESENCE_FLUSH_INTERVAL = getattr(settings_module, "PRESENCE_FLUSH_INTERVAL", 60)
+
 GOOGLE_DEVELOPER_KEY = settings_module.GOOGLE_DEVELOPER_KEY
 GOOGLE_CUSTOM_SEARCH_CX = settings_module.GOOGLE_CUSTOM_SEARCH_CX
+GOOGLE_SEARCH_URL = getattr(settings_module, "GOOGLE_SEARCH_URL", "https://www.googleapis.com/customsearch/v1")
+GOOGLE_SEARCH_TIMEOUT = getattr(settings_module, "GOOGLE_SEARCH_TIMEOUT", 10)
+YOUTUBE_API_URL = getattr(settings_module, "YOUTUBE_API_URL", "https://www.googleapis.com/youtube/v3/videos")
+YOUTUBE_API_TIMEOUT = getattr(settings_module, "YOUTUBE_API_TIMEOUT", 10)
+YOUTUBE_CACHE_SIZE = getattr(settings_module, "YOUTUBE_CACHE_SIZE", 500)
+
+# Seconds before the in-memory quote index is rebuilt from the database
+QUOTE_INDEX_REFRESH = getattr(settings_module, "QUOTE_INDEX_REFRESH", 3600)
+
+# Hours for which polls are open, and days after closing that they are deleted
+POLL_DURATION = getattr(settings_module, "POLL_DURATION", 24*7)
+POLL_EXPIRY = getattr(settings_module, "POLL_EXPIRY", 90)
+
+# Number of URLs remembered per channel, and where to keep them between restarts
+URL_HISTORY_SIZE = getattr(settings_module, "URL_HISTORY_SIZE", 100)
+URL_HISTORY_FILE = getattr(settings_module, "URL_HISTORY_FILE", None)
 
 
 
@@ -0,0 +1,3 @@
+"""
+Utilities for exercising the bot without a real chat network.
+"""
@@ -0,0 +1,501 @@
+"""
+A fake IRC server, for running the bot against without a real network.
+
+It speaks just enough of RFC 1459 for irc3: registration, PING, JOIN,
+PART, WHO (including the WHOX form), PRIVMSG, NOTICE, NICK, TOPIC,
+MODE queries and QUIT. Everything is kept in memory and there are no
+flood limits, so it can be used to load the bot with many synthetic
+users (see loadtest.py). It also supports the +D (deaf) user mode, so
+synthetic users don't have to receive all of the channel traffic.
+
+Run it on its own with:
+
+    python -m smaug.bot.testing.fakeircd --port 6667
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+ISUPPORT = "CHANTYPES=# PREFIX=(ov)@+ CHANMODES=b,k,l,imnpst NICKLEN=30 " \
+           "CASEMAPPING=ascii NETWORK=FakeNet WHOX"
+
+# Fields of a WHOX reply, in the order they are sent
+WHOX_FIELDS = "tcuihsnfdlar"
+
+
+def parseLine(line):
+    """ Split a line into (prefix, command, params). The trailing
+        parameter, if any, is the last one in params.
+    """
+    prefix = None
+    if line.startswith(":"):
+        prefix, _, line = line[1:].partition(" ")
+    trailing = None
+    if " :" in line:
+        line, trailing = line.split(" :", 1)
+    elif line.startswith(":"):
+        line, trailing = "", line[1:]
+    params = line.split()
+    if trailing is not None:
+        params.append(trailing)
+    if not params:
+        return prefix, None, []
+    return prefix, params[0].upper(), params[1:]
+
+
+class FakeClient(object):
+    """ A connection to the fake server
+    """
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.nick = None
+        self.user = None
+        self.realname = None
+        self.host = "localhost"
+        self.registered = False
+        self.deaf = False
+        self.channels = set()
+        self.connected = time.time()
+
+
+    @property
+    def mask(self):
+        return "%s!%s@%s" % (self.nick, self.user, self.host)
+
+
+    def send(self, line):
+        if self.writer.transport.is_closing(): return
+        self.writer.write(line.encode("utf-8", "replace") + b"\r\n")
+        self.server.linesOut += 1
+
+
+    def reply(self, code, *params):
+        """ Send a numeric reply. The last parameter is sent as
+            the trailing parameter.
+        """
+        params = list(params)
+        if params:
+            params[-1] = ":" + params[-1]
+        self.send(" ".join([":" + self.server.name, code, self.nick or "*"] + params))
+
+
+    def close(self):
+        self.writer.close()
+
+
+    def __repr__(self):
+        return self.nick or "<unregistered>"
+
+
+class FakeIRCServer(object):
+    """ host, port: address to listen on. Port 0 picks a free port,
+            which is available as self.port once started.
+        name: server name used in replies
+    """
+
+    def __init__(self, host="127.0.0.1", port=6667, name="irc.fake.net", loop=None):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.loop = loop or asyncio.get_event_loop()
+        self.server = None
+        self.clients = set()
+        # lowercase nick -> client
+        self.nicks = {}
+        # lowercase channel name -> set of clients
+        self.channels = {}
+        self.topics = {}
+        # called with (client, command, target, text) for every PRIVMSG and NOTICE
+        self.listeners = []
+        # (nick, channel, future) waiting for a nick to join a channel
+        self.joinWaiters = []
+        self.linesIn = 0
+        self.linesOut = 0
+
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handleClient, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info("Fake IRC server listening on %s:%d" % (self.host, self.port))
+
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        for client in list(self.clients):
+            client.close()
+
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+
+    async def waitForJoin(self, nick, channel, timeout=None):
+        """ Wait until someone with the given nick is in the channel
+        """
+        members = self.channels.get(channel.lower(), ())
+        if any([c.nick.lower() == nick.lower() for c in members]):
+            return
+        f = self.loop.create_future()
+        self.joinWaiters.append((nick.lower(), channel.lower(), f))
+        await asyncio.wait_for(f, timeout)
+
+
+    async def handleClient(self, reader, writer):
+        client = FakeClient(self, reader, writer)
+        peer = writer.get_extra_info("peername")
+        if peer:
+            client.host = peer[0]
+        self.clients.add(client)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line: break
+                self.linesIn += 1
+                line = line.decode("utf-8", "replace").rstrip("\r\n")
+                if line:
+                    await self.handleLine(client, line)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception:
+            logger.exception("Error handling client %s" % client)
+        finally:
+            self.disconnect(client, "Connection closed")
+
+
+    async def handleLine(self, client, line):
+        prefix, command, params = parseLine(line)
+        if not command: return
+        handler = getattr(self, "irc_" + command, None)
+        if handler is None:
+            if client.registered:
+                client.reply("421", command, "Unknown command")
+            return
+        if not client.registered and command not in ("NICK", "USER", "PASS", "CAP", "PING", "QUIT"):
+            client.reply("451", "You have not registered")
+            return
+        handler(client, params)
+        if client.writer.transport.get_write_buffer_size() > 65536:
+            await client.writer.drain()
+
+
+    def sendTo(self, clients, line):
+        for client in clients:
+            client.send(line)
+
+
+    def peers(self, client):
+        """ Everyone who shares a channel with the client, and the client
+        """
+        peers = set([client])
+        for channel in client.channels:
+            peers.update(self.channels[channel])
+        return peers
+
+
+    def disconnect(self, client, message):
+        if client not in self.clients: return
+        self.clients.discard(client)
+        if client.registered:
+            peers = self.peers(client)
+            peers.discard(client)
+            self.sendTo(peers, ":%s QUIT :%s" % (client.mask, message))
+        for channel in client.channels:
+            self.removeMember(channel, client)
+        client.channels = set()
+        if client.nick and self.nicks.get(client.nick.lower()) is client:
+            del self.nicks[client.nick.lower()]
+        client.close()
+
+
+    def removeMember(self, channel, client):
+        members = self.channels.get(channel)
+        if members is None: return
+        members.discard(client)
+        if not members:
+            del self.channels[channel]
+            self.topics.pop(channel, None)
+
+
+    # Registration
+
+    def irc_PASS(self, client, params):
+        pass
+
+
+    def irc_CAP(self, client, params):
+        if params and params[0].upper() == "LS":
+            client.send(":%s CAP * LS :" % self.name)
+
+
+    def irc_NICK(self, client, params):
+        if not params:
+            client.reply("431", "No nickname given")
+            return
+        nick = params[0]
+        other = self.nicks.get(nick.lower())
+        if other and other is not client:
+            client.reply("433", nick, "Nickname is already in use")
+            return
+        if client.registered:
+            self.sendTo(self.peers(client), ":%s NICK :%s" % (client.mask, nick))
+            del self.nicks[client.nick.lower()]
+            client.nick = nick
+            self.nicks[nick.lower()] = client
+        else:
+            if client.nick and self.nicks.get(client.nick.lower()) is client:
+                del self.nicks[client.nick.lower()]
+            client.nick = nick
+            self.nicks[nick.lower()] = client
+            self.register(client)
+
+
+    def irc_USER(self, client, params):
+        if len(params) < 4:
+            client.reply("461", "USER", "Not enough parameters")
+            return
+        client.user = params[0]
+        client.realname = params[3]
+        self.register(client)
+
+
+    def register(self, client):
+        if client.registered or not client.nick or not client.user: return
+        client.registered = True
+        client.reply("001", "Welcome to the fake IRC network %s" % client.mask)
+        client.reply("002", "Your host is %s, running fakeircd" % self.name)
+        client.reply("003", "This server was created just now")
+        client.send(":%s 004 %s %s fakeircd iowD bklmnopstv" % (self.name, client.nick, self.name))
+        client.send(":%s 005 %s %s :are supported by this server" % (self.name, client.nick, ISUPPORT))
+        client.reply("375", "- %s Message of the day -" % self.name)
+        client.reply("372", "- Nothing to see here")
+        client.reply("376", "End of /MOTD command.")
+
+
+    def irc_PING(self, client, params):
+        client.send(":%s PONG %s :%s" % (self.name, self.name, params[0] if params else self.name))
+
+
+    def irc_PONG(self, client, params):
+        pass
+
+
+    def irc_QUIT(self, client, params):
+        message = params[0] if params else "Quit"
+        client.send("ERROR :Closing link (%s)" % message)
+        self.disconnect(client, "Quit: %s" % message)
+
+
+    # Channels
+
+    def irc_JOIN(self, client, params):
+        if not params:
+            client.reply("461", "JOIN", "Not enough parameters")
+            return
+        for name in params[0].split(","):
+            if not name.startswith("#"):
+                client.reply("403", name, "No such channel")
+                continue
+            channel = name.lower()
+            if channel in client.channels: continue
+            members = self.channels.setdefault(channel, set())
+            members.add(client)
+            client.channels.add(channel)
+            self.sendTo(members, ":%s JOIN :%s" % (client.mask, name))
+            topic = self.topics.get(channel)
+            if topic:
+                client.reply("332", name, topic[0])
+                client.reply("333", name, topic[1], str(int(topic[2])))
+            self.sendNames(client, name)
+            self.notifyJoin(client, channel)
+
+
+    def notifyJoin(self, client, channel):
+        waiters = []
+        for waiter in self.joinWaiters:
+            nick, name, f = waiter
+            if f.done(): continue
+            if nick == client.nick.lower() and name == channel:
+                f.set_result(True)
+            else:
+                waiters.append(waiter)
+        self.joinWaiters = waiters
+
+
+    def sendNames(self, client, name):
+        nicks = sorted([c.nick for c in self.channels.get(name.lower(), ())])
+        # keep each line well under the 512 byte limit
+        for i in range(0, len(nicks), 40):
+            client.reply("353", "=", name, " ".join(nicks[i:i+40]))
+        client.reply("366", name, "End of /NAMES list.")
+
+
+    def irc_NAMES(self, client, params):
+        for name in (params[0].split(",") if params else ()):
+            self.sendNames(client, name)
+
+
+    def irc_PART(self, client, params):
+        if not params:
+            client.reply("461", "PART", "Not enough parameters")
+            return
+        message = params[1] if len(params) > 1 else client.nick
+        for name in params[0].split(","):
+            channel = name.lower()
+            if channel not in client.channels:
+                client.reply("442", name, "You're not on that channel")
+                continue
+            self.sendTo(self.channels[channel], ":%s PART %s :%s" % (client.mask, name, message))
+            client.channels.discard(channel)
+            self.removeMember(channel, client)
+
+
+    def irc_TOPIC(self, client, params):
+        if not params:
+            client.reply("461", "TOPIC", "Not enough parameters")
+            return
+        name = params[0]
+        channel = name.lower()
+        if len(params) == 1:
+            topic = self.topics.get(channel)
+            if topic:
+                client.reply("332", name, topic[0])
+            else:
+                client.reply("331", name, "No topic is set")
+        elif channel in client.channels:
+            self.topics[channel] = (params[1], client.nick, time.time())
+            self.sendTo(self.channels[channel], ":%s TOPIC %s :%s" % (client.mask, name, params[1]))
+
+
+    def irc_MODE(self, client, params):
+        if not params: return
+        target = params[0]
+        if target.startswith("#"):
+            if len(params) == 1:
+                client.send(":%s 324 %s %s +nt" % (self.name, client.nick, target))
+        elif target.lower() == client.nick.lower() and len(params) > 1:
+            # only the deaf mode is supported, for synthetic users
+            if "D" in params[1]:
+                client.deaf = params[1].startswith("+")
+            client.send(":%s MODE %s :%s" % (client.mask, client.nick, params[1]))
+
+
+    def irc_WHO(self, client, params):
+        if not params:
+            client.reply("315", "*", "End of /WHO list.")
+            return
+        target = params[0]
+        if target.startswith("#"):
+            members = self.channels.get(target.lower(), ())
+        else:
+            other = self.nicks.get(target.lower())
+            members = [other] if other else ()
+        whox = None
+        if len(params) > 1 and "%" in params[1]:
+            whox = params[1].split("%", 1)[1]
+        for member in sorted(members, key=lambda c: c.nick.lower()):
+            if whox is not None:
+                self.sendWhox(client, target, member, whox)
+            else:
+                client.send(":%s 352 %s %s %s %s %s %s H :0 %s" % (self.name, client.nick,
+                        target, member.user, member.host, self.name, member.nick, member.realname))
+        client.reply("315", target, "End of /WHO list.")
+
+
+    def sendWhox(self, client, target, member, flags):
+        """ Send a WHOX (354) reply with the requested fields,
+            e.g. flags "tcuhnfdar,123"
+        """
+        fields, _, token = flags.partition(",")
+        values = {
+            't': token or "0",
+            'c': target if target.startswith("#") else "*",
+            'u': member.user,
+            'i': "255.255.255.255",
+            'h': member.host,
+            's': self.name,
+            'n': member.nick,
+            'f': "H",
+            'd': "0",
+            'l': str(int(time.time() - member.connected)),
+            'a': "0",
+            'r': ":" + member.realname,
+        }
+        params = [values[f] for f in WHOX_FIELDS if f in fields]
+        client.send(" ".join([":" + self.name, "354", client.nick] + params))
+
+
+    # Messages
+
+    def irc_PRIVMSG(self, client, params):
+        self.sendMessage(client, "PRIVMSG", params)
+
+
+    def irc_NOTICE(self, client, params):
+        self.sendMessage(client, "NOTICE", params)
+
+
+    def sendMessage(self, client, command, params):
+        if len(params) < 2:
+            if command == "PRIVMSG":
+                client.reply("412", "No text to send")
+            return
+        targets, text = params[0], params[1]
+        for target in targets.split(","):
+            line = ":%s %s %s :%s" % (client.mask, command, target, text)
+            if target.startswith("#"):
+                channel = target.lower()
+                if channel not in client.channels:
+                    if command == "PRIVMSG":
+                        client.reply("404", target, "Cannot send to channel")
+                    continue
+                self.sendTo([c for c in self.channels[channel] \
+                        if c is not client and not c.deaf], line)
+            else:
+                other = self.nicks.get(target.lower())
+                if not other:
+                    if command == "PRIVMSG":
+                        client.reply("401", target, "No such nick/channel")
+                    continue
+                self.sendTo([other], line)
+            for listener in self.listeners:
+                listener(client, command, target, text)
+
+
+    def __repr__(self):
+        return "%d clients, %d channels, %d lines in, %d lines out" % \
+            (len(self.clients), len(self.channels), self.linesIn, self.linesOut)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake IRC server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6667)
+    parser.add_argument("--name", default="irc.fake.net")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    loop = asyncio.get_event_loop()
+    server = FakeIRCServer(args.host, args.port, args.name, loop=loop)
+    loop.run_until_complete(server.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Stopping: %s" % server)
+        loop.run_until_complete(server.stop())
+
+
+if __name__ == "__main__":
+    main()
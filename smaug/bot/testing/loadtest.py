@@ -0,0 +1,270 @@
+"""
+Load test for the IRC side of the bot.
+
+Starts a fake IRC server (see fakeircd.py) and waits for the bot to join
+the channel. Then N synthetic users join and talk at the given rate,
+changing nicks now and then, and finally quit. Every message carries a
+tag, and the bot's log file for the channel is tailed, so that the time
+from sending a message to the bot logging it can be measured.
+
+To run it, point a bot at the fake server in bot_settings.py, e.g.
+
+    IRC_SERVER = '127.0.0.1'
+    IRC_PORT = 6697
+    PROTOCOLS = ('irc',)
+
+then start the load test, followed by the bot:
+
+    python -m smaug.bot.testing.loadtest --port 6697 --nick Smaug \\
+        --channel '#smaug' --logdir logs/irc --users 50 --rate 0.5
+
+The latency includes up to --poll seconds spent waiting to notice a new
+log line.
+"""
+
+from smaug.bot.testing.fakeircd import FakeIRCServer
+
+from glob import glob
+import argparse
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+# A message's tag is lt:<user>:<sequence>
+TAG = re.compile(r"^\d+ <[^>]+> lt:(\d+):(\d+) ")
+
+FILLER = "the quick brown fox jumps over the lazy dragon and his hoard of gold "
+
+
+class SyntheticUser(object):
+    """ A scripted client of the fake server
+    """
+
+    def __init__(self, test, index):
+        self.test = test
+        self.index = index
+        self.nick = "user%d" % index
+        self.away = False
+        self.sequence = 0
+        self.reader = None
+        self.writer = None
+
+
+    def send(self, line):
+        self.writer.write(line.encode("utf-8") + b"\r\n")
+
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.test.host, self.test.port)
+        self.send("NICK %s" % self.nick)
+        self.send("USER lt%d 0 * :Synthetic user %d" % (self.index, self.index))
+        # deaf, so we don't receive everyone else's messages
+        self.send("MODE %s +D" % self.nick)
+        self.send("JOIN %s" % self.test.channel)
+        await self.writer.drain()
+        asyncio.ensure_future(self.read())
+
+
+    async def read(self):
+        """ Discard whatever the server sends, except for PINGs
+        """
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line: break
+                if line.startswith(b"PING "):
+                    self.send("PONG " + line[5:].decode("utf-8").strip())
+        except ConnectionError:
+            pass
+
+
+    async def talk(self, until):
+        test = self.test
+        while True:
+            await asyncio.sleep(random.expovariate(test.rate))
+            if time.time() >= until: break
+            if test.churn and random.random() < test.churn:
+                self.changeNick()
+            self.sequence += 1
+            text = "lt:%d:%d %s" % (self.index, self.sequence, test.filler)
+            test.sent[(self.index, self.sequence)] = time.time()
+            self.send("PRIVMSG %s :%s" % (test.channel, text))
+            await self.writer.drain()
+
+
+    def changeNick(self):
+        self.away = not self.away
+        self.nick = "user%d|away" % self.index if self.away else "user%d" % self.index
+        self.send("NICK %s" % self.nick)
+
+
+    async def quit(self):
+        self.send("QUIT :Load test finished")
+        await self.writer.drain()
+        self.writer.close()
+
+
+class LogTail(object):
+    """ Follows the bot's newest log file for a channel,
+        even if the bot only creates it after we start
+    """
+
+    def __init__(self, logdir, channel):
+        self.pattern = os.path.join(logdir, "%s_*.log" % channel)
+        self.filename = None
+        self.fh = None
+        self.partial = ""
+        # skip whatever was logged before the test
+        self.open(toEnd=True)
+
+
+    def open(self, toEnd=False):
+        files = sorted(glob(self.pattern))
+        if not files or files[-1] == self.filename: return
+        if self.fh:
+            self.fh.close()
+        self.filename = files[-1]
+        self.fh = open(self.filename, "r", encoding="utf-8", errors="replace")
+        if toEnd:
+            self.fh.seek(0, os.SEEK_END)
+
+
+    def readLines(self):
+        self.open()
+        if not self.fh: return []
+        data = self.partial + self.fh.read()
+        lines = data.split("\n")
+        self.partial = lines.pop()
+        return lines
+
+
+class LoadTest(object):
+
+    def __init__(self, args):
+        self.host = args.host
+        self.port = args.port
+        self.nick = args.nick
+        self.channel = args.channel
+        self.users = args.users
+        self.rate = args.rate
+        self.duration = args.duration
+        self.churn = args.churn
+        self.drain = args.drain
+        self.poll = args.poll
+        self.connectRate = args.connect_rate
+        self.filler = (FILLER * (args.size // len(FILLER) + 1))[:args.size]
+        self.server = FakeIRCServer(self.host, self.port)
+        self.tail = LogTail(args.logdir, self.channel)
+        # (user, sequence) -> time sent
+        self.sent = {}
+        self.latencies = []
+        self.replies = 0
+
+
+    def onMessage(self, client, command, target, text):
+        """ Count what the bot says, e.g. replies to commands in the chatter
+        """
+        if client.nick.lower() == self.nick.lower():
+            self.replies += 1
+
+
+    def collect(self):
+        now = time.time()
+        for line in self.tail.readLines():
+            m = TAG.match(line)
+            if not m: continue
+            key = (int(m.group(1)), int(m.group(2)))
+            sent = self.sent.pop(key, None)
+            if sent is not None:
+                self.latencies.append(now - sent)
+
+
+    async def collectUntil(self, until):
+        while time.time() < until:
+            self.collect()
+            await asyncio.sleep(self.poll)
+
+
+    async def run(self):
+        await self.server.start()
+        self.server.addListener(self.onMessage)
+        logger.info("Waiting for %s to join %s on port %d..." % (self.nick, self.channel, self.server.port))
+        await self.server.waitForJoin(self.nick, self.channel)
+        # give the bot a moment to process its WHO results
+        await asyncio.sleep(2)
+
+        logger.info("Connecting %d users..." % self.users)
+        users = []
+        for i in range(self.users):
+            user = SyntheticUser(self, i+1)
+            await user.connect()
+            users.append(user)
+            await asyncio.sleep(1.0/self.connectRate)
+
+        logger.info("Talking for %d seconds..." % self.duration)
+        start = time.time()
+        until = start + self.duration
+        talkers = asyncio.gather(*[user.talk(until) for user in users])
+        await asyncio.gather(talkers, self.collectUntil(until))
+        sent = sum([user.sequence for user in users])
+
+        logger.info("Waiting up to %d seconds for the log to catch up..." % self.drain)
+        deadline = time.time() + self.drain
+        while self.sent and time.time() < deadline:
+            self.collect()
+            await asyncio.sleep(self.poll)
+        elapsed = time.time() - start
+
+        for user in users:
+            await user.quit()
+        await asyncio.sleep(1)
+        self.report(sent, elapsed)
+        await self.server.stop()
+
+
+    def report(self, sent, elapsed):
+        logged = len(self.latencies)
+        print("Users:       %d at %.2f messages/s each" % (self.users, self.rate))
+        print("Sent:        %d messages (%.1f/s)" % (sent, sent/float(self.duration)))
+        print("Logged:      %d messages (%.1f/s), %d missing" % (logged, logged/elapsed, len(self.sent)))
+        print("Bot replies: %d" % self.replies)
+        print("Server:      %s" % self.server)
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            def percentile(p):
+                return latencies[min(len(latencies)-1, int(len(latencies)*p))] * 1000
+            print("Latency:     p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms" % \
+                (percentile(0.5), percentile(0.9), percentile(0.99), latencies[-1]*1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot with a fake IRC server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6667)
+    parser.add_argument("--nick", required=True, help="the bot's nick")
+    parser.add_argument("--channel", required=True, help="a channel the bot joins")
+    parser.add_argument("--logdir", required=True, help="the bot's IRC_LOGDIR")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=0.2, help="messages per second per user")
+    parser.add_argument("--duration", type=int, default=60, help="seconds of talking")
+    parser.add_argument("--size", type=int, default=80, help="characters of filler per message")
+    parser.add_argument("--churn", type=float, default=0.0,
+            help="chance that a user changes nick before each message")
+    parser.add_argument("--connect-rate", type=float, default=20, help="users connecting per second")
+    parser.add_argument("--drain", type=int, default=30, help="seconds to wait for the log after talking")
+    parser.add_argument("--poll", type=float, default=0.005, help="seconds between log file checks")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(LoadTest(args).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def collapse_versions(apps, schema_editor):
+    """ Previously, every edit of a Discord message added a new LogLine with
+        the same external id. Keep the first LogLine (so the message stays
+        where it was said) with the latest body, and move the older bodies
+        into the history table.
+    """
+    LogLine = apps.get_model('ircview', 'LogLine')
+    LogLineVersion = apps.get_model('ircview', 'LogLineVersion')
+
+    LogLine.objects.filter(edited_yn='Y').update(edited=True)
+    LogLine.objects.filter(deleted_yn='Y').update(deleted=True)
+
+    external_ids = LogLine.objects.filter(external_id__isnull=False) \
+            .values('external_id').annotate(n=Count('id')).filter(n__gt=1) \
+            .values_list('external_id', flat=True)
+
+    for external_id in list(external_ids):
+        lines = list(LogLine.objects.filter(external_id=external_id).order_by('id'))
+        first = lines[0]
+        for prev, line in zip(lines, lines[1:]):
+            LogLineVersion.objects.create(line=first, body=prev.body, stamp=line.stamp)
+        first.body = lines[-1].body
+        first.edited = True
+        first.deleted = any([line.deleted for line in lines])
+        first.save()
+        LogLine.objects.filter(id__in=[line.id for line in lines[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ircview', '0002_auto_20171225_2112'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogLineVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField(blank=True, null=True)),
+                ('stamp', models.DateTimeField()),
+                ('line', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='ircview.LogLine')),
+            ],
+        ),
+        migrations.RenameField(
+            model_name='logline',
+            old_name='edited',
+            new_name='edited_yn',
+        ),
+        migrations.RenameField(
+            model_name='logline',
+            old_name='deleted',
+            new_name='deleted_yn',
+        ),
+        migrations.AddField(
+            model_name='logline',
+            name='edited',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='logline',
+            name='deleted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(collapse_versions, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='logline',
+            name='edited_yn',
+        ),
+        migrations.RemoveField(
+            model_name='logline',
+            name='deleted_yn',
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ircview', '0003_logline_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShortUrl',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=32, unique=True)),
+                ('url', models.TextField()),
+                ('stamp', models.DateTimeField()),
+            ],
+        ),
+    ]
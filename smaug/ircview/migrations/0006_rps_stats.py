@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ircview', '0005_polls'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RpsStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wins', models.IntegerField(db_index=True, default=0)),
+                ('losses', models.IntegerField(default=0)),
+                ('streak', models.IntegerField(default=0)),
+                ('best_streak', models.IntegerField(default=0)),
+                ('worst_streak', models.IntegerField(default=0)),
+                ('rock', models.IntegerField(default=0)),
+                ('paper', models.IntegerField(default=0)),
+                ('scissors', models.IntegerField(default=0)),
+                ('spock', models.IntegerField(default=0)),
+                ('lizard', models.IntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='rps_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RpsGambit',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gambit', models.CharField(max_length=3)),
+                ('count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rps_gambits', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='rpsgambit',
+            unique_together=set([('user', 'gambit')]),
+        ),
+    ]
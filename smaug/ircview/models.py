@@ -1,8 +1,11 @@
-from django.db import models
+from django.db import models, connection, transaction
+from django.db.models import F
 from django.contrib.auth.models import (
     BaseUserManager, AbstractBaseUser, PermissionsMixin
 )
 
+from datetime import datetime
+import hashlib
 import re
 
 YES_NO = (
@@ -15,6 +18,8 @@ PROTOCOLS = (
     ('discord','Discord')
 )
 
+BASE62 = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
 COLORS = (
     ('white','White'),
     ('black','Black'),
@@ -135,6 +140,27 @@ class IrcUserHost(models.Model):
         list_display = ('user','host',)
 
 
+class LogLineManager(models.Manager):
+
+    def editLine(self, external_id, body):
+        """ Replace the body of the line with the given external id, 
+            copying the current version into the history table first.
+        """
+        now = datetime.now()
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("""insert into %s (line_id, body, stamp)
+                                  select id, body, %%s from %s where external_id = %%s""" % \
+                                  (LogLineVersion._meta.db_table, self.model._meta.db_table),
+                                  [now, external_id])
+            return self.filter(external_id=external_id).update(body=body, edited=True)
+
+    def deleteLine(self, external_id):
+        """ Mark the line with the given external id as deleted
+        """
+        return self.filter(external_id=external_id).update(deleted=True)
+
+
 class LogLine(models.Model):
     stamp = models.DateTimeField(db_index=True)
     proto = models.CharField(max_length=8, choices=PROTOCOLS, db_index=True)
@@ -144,8 +170,9 @@ class LogLine(models.Model):
     year = models.IntegerField(blank=True, null=True, db_index=True)
     month = models.IntegerField(blank=True, null=True, db_index=True)
     external_id = models.BigIntegerField(null=True, blank=True, db_index=True)
-    edited = models.CharField(blank=True, null=True, max_length=1, choices=YES_NO, db_index=True, default='N')
-    deleted = models.CharField(blank=True, null=True, max_length=1, choices=YES_NO, db_index=True, default='N')
+    edited = models.BooleanField(default=False)
+    deleted = models.BooleanField(default=False)
+    objects = LogLineManager()
 
     def __unicode__(self):
         return "<%s> %s" % (self.handle, self.body)
@@ -155,6 +182,19 @@ class LogLine(models.Model):
             ["year", "month"],
         ]
 
+
+class LogLineVersion(models.Model):
+    """ A prior version of an edited LogLine. The stamp is 
+        the time at which this version was replaced.
+    """
+    line = models.ForeignKey(LogLine, related_name="versions")
+    body = models.TextField(blank=True, null=True)
+    stamp = models.DateTimeField()
+
+    def __unicode__(self):
+        return "<%s> %s" % (self.line.handle, self.body)
+
+
 class Message(models.Model):
     from_user = models.ForeignKey(SmaugUser, related_name="sent")
     to_user = models.ForeignKey(SmaugUser, related_name="recieved")
@@ -191,9 +231,228 @@ class RpsGame(models.Model):
         list_display = ('id','winner','loser','winner_play','loser_play','rounds',)
 
 
+RPS_THROWS = (
+    ('r', 'rock'),
+    ('p', 'paper'),
+    ('s', 'scissors'),
+    ('v', 'spock'),
+    ('l', 'lizard'),
+)
+
+
+class RpsStatsManager(models.Manager):
+
+    def record(self, game):
+        """ Save the given game, and update both players' statistics.
+
+            Note that the tables are MyISAM (see web_settings), which has 
+            neither transactions nor row locks, so the atomic block and 
+            select_for_update only take effect on a transactional engine. 
+            The statistics are updated before the game is saved, so a 
+            failure can't leave a recorded game missing from them. If the 
+            statistics do drift, !rpsrebuild recomputes them from the games.
+        """
+        with transaction.atomic():
+            for user, won, play in ((game.winner, True, game.winner_play), 
+                                    (game.loser, False, game.loser_play)):
+                stats = self.select_for_update().filter(user=user).first() or self.model(user=user)
+                stats.add(won, play)
+                stats.save()
+                gambit = RpsGambit.objects.select_for_update().filter(user=user, gambit=play).first() \
+                        or RpsGambit(user=user, gambit=play)
+                gambit.count += 1
+                gambit.save()
+            game.save()
+
+    def rebuild(self):
+        """ Recompute everyone's statistics from the game history. 
+            Returns the number of players.
+        """
+        stats = {}
+        gambits = {}
+        with transaction.atomic():
+            RpsGambit.objects.all().delete()
+            self.all().delete()
+            for game in RpsGame.objects.order_by('id').iterator():
+                for userId, won, play in ((game.winner_id, True, game.winner_play), 
+                                          (game.loser_id, False, game.loser_play)):
+                    if userId not in stats:
+                        stats[userId] = self.model(user_id=userId)
+                    stats[userId].add(won, play)
+                    gambits[(userId, play)] = gambits.get((userId, play), 0) + 1
+            self.bulk_create(list(stats.values()))
+            RpsGambit.objects.bulk_create([RpsGambit(user_id=userId, gambit=play, count=count) \
+                    for (userId, play), count in gambits.items()])
+        return len(stats)
+
+
+class RpsStats(models.Model):
+    """ Running totals of a user's RPS games. The streak is positive 
+        for consecutive wins and negative for consecutive losses.
+    """
+    user = models.OneToOneField(SmaugUser, related_name="rps_stats")
+    wins = models.IntegerField(default=0, db_index=True)
+    losses = models.IntegerField(default=0)
+    streak = models.IntegerField(default=0)
+    best_streak = models.IntegerField(default=0)
+    worst_streak = models.IntegerField(default=0)
+    rock = models.IntegerField(default=0)
+    paper = models.IntegerField(default=0)
+    scissors = models.IntegerField(default=0)
+    spock = models.IntegerField(default=0)
+    lizard = models.IntegerField(default=0)
+    objects = RpsStatsManager()
+
+    def add(self, won, play):
+        """ Count a game with the given result and sequence of throws
+        """
+        if won:
+            self.wins += 1
+            self.streak = self.streak+1 if self.streak > 0 else 1
+            self.best_streak = max(self.best_streak, self.streak)
+        else:
+            self.losses += 1
+            self.streak = self.streak-1 if self.streak < 0 else -1
+            self.worst_streak = max(self.worst_streak, -self.streak)
+        throws = dict(RPS_THROWS)
+        for code in play or "":
+            if code in throws:
+                setattr(self, throws[code], getattr(self, throws[code]) + 1)
+
+    def get_favourite_throw(self):
+        """ Returns the name and count of the user's most frequent throw
+        """
+        return max([(getattr(self, name), name) for code, name in RPS_THROWS])[::-1]
+
+    def __unicode__(self):
+        return "%s: %d-%d" % (self.user, self.wins, self.losses)
+
+
+class RpsGambit(models.Model):
+    """ Number of games in which a user played a sequence of throws
+    """
+    user = models.ForeignKey(SmaugUser, related_name="rps_gambits")
+    gambit = models.CharField(max_length=3)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("user", "gambit")
+
+
 class QuoteLink(models.Model):
     pub_date = models.DateField()
     match_text = models.TextField()
     title = models.CharField(max_length=255)
     url = models.TextField()
 
+
+
+class ShortUrlManager(models.Manager):
+
+    CODE_LENGTH = 6
+
+    def shorten(self, url):
+        """ Returns the ShortUrl for the given URL, creating it if needed.
+            The code is derived from a hash of the URL, so the same URL 
+            always gets the same code. On the rare collision with another 
+            URL, the code is lengthened by one character until it is unique.
+        """
+        n = int(hashlib.sha1(url.encode("utf-8")).hexdigest(), 16)
+        digits = []
+        while n:
+            n, r = divmod(n, 62)
+            digits.append(BASE62[r])
+        code = "".join(digits)
+
+        length = self.CODE_LENGTH
+        while True:
+            shorturl, created = self.get_or_create(code=code[:length], 
+                    defaults={'url':url, 'stamp':datetime.now()})
+            if shorturl.url == url or length >= len(code):
+                return shorturl
+            length += 1
+
+
+class ShortUrl(models.Model):
+    code = models.CharField(unique=True, max_length=32)
+    url = models.TextField()
+    stamp = models.DateTimeField()
+    objects = ShortUrlManager()
+
+    def __unicode__(self):
+        return "%s -> %s" % (self.code, self.url)
+
+
+class PollManager(models.Manager):
+
+    def vote(self, poll, user, answers):
+        """ Record the user's vote for the given answers. Counters are 
+            updated in place, so the tally never needs to count votes. 
+            Returns False if the user already voted in this poll.
+
+            Note that the tables are MyISAM (see web_settings), which has 
+            neither transactions nor row locks, so the atomic block and 
+            select_for_update only take effect on a transactional engine. 
+            On MyISAM, the unique (answer, user) constraint is what stops 
+            a user voting twice for the same answer.
+        """
+        with transaction.atomic():
+            # lock the poll, so concurrent votes by the same user are serialized
+            self.select_for_update().get(id=poll.id)
+            if PollVote.objects.filter(poll=poll, user=user).exists():
+                return False
+            now = datetime.now()
+            PollVote.objects.bulk_create([PollVote(poll=poll, answer=answer, user=user, stamp=now) \
+                    for answer in answers])
+            PollAnswer.objects.filter(id__in=[a.id for a in answers]).update(votes=F('votes')+1)
+            self.filter(id=poll.id).update(voters=F('voters')+1)
+            return True
+
+    def expire(self, before):
+        """ Delete the polls which closed before the given time, 
+            along with their answers and votes
+        """
+        return self.filter(closes__lt=before).delete()
+
+
+class Poll(models.Model):
+    question = models.TextField()
+    author = models.ForeignKey(SmaugUser, related_name="polls")
+    multiple = models.BooleanField(default=False)
+    voters = models.IntegerField(default=0)
+    created = models.DateTimeField()
+    closes = models.DateTimeField(db_index=True)
+    objects = PollManager()
+
+    def is_open(self):
+        return self.closes > datetime.now()
+
+    def __unicode__(self):
+        return self.question
+
+
+class PollAnswer(models.Model):
+    poll = models.ForeignKey(Poll, related_name="answers")
+    number = models.IntegerField()
+    text = models.CharField(max_length=255)
+    votes = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return self.text
+
+    class Meta:
+        unique_together = ("poll", "number")
+        ordering = ("number",)
+
+
+class PollVote(models.Model):
+    poll = models.ForeignKey(Poll, related_name="ballots")
+    answer = models.ForeignKey(PollAnswer, related_name="ballots")
+    user = models.ForeignKey(SmaugUser, related_name="poll_votes")
+    stamp = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("answer", "user")
+        index_together = [
+            ["poll", "user"],
+        ]
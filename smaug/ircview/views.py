@@ -3,6 +3,8 @@ from django.shortcuts import render
 from django.views.decorators.cache import never_cache
 from django.contrib.auth.decorators import permission_required
 from django.shortcuts import get_object_or_404
+from django.http import HttpResponseRedirect
+from django.core.cache import cache
 
 from django import forms
 
@@ -14,6 +16,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 PAGE_SIZE = 50 
+SHORTURL_CACHE_TIMEOUT = 60*60*24
 INPUT_DATE_FORMAT= '%Y-%m-%d'
 MONTHS = ('Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec')
 
@@ -36,6 +39,18 @@ def message(request, messageId):
     })
 
 
+def shorturl(request, code):
+    """ Redirect a short URL created by the bot. These are public, 
+        since they are posted in the channels.
+    """
+    key = "shorturl:%s" % code
+    url = cache.get(key)
+    if url is None:
+        url = get_object_or_404(models.ShortUrl, code=code).url
+        cache.set(key, url, SHORTURL_CACHE_TIMEOUT)
+    return HttpResponseRedirect(url)
+
+
 @permission_required("ircview.can_view_logs")
 def index(request):
 
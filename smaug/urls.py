@@ -27,6 +27,7 @@ urlpatterns = [
     url(r'^ircview/search/?$', ircviews.search, name='search'),
     url(r'^ircview/media/(?P<path>.*)$', serve, { 'document_root': settings.MEDIA_ROOT, }),
     url(r'^ircview/message/(\d+)$', ircviews.message, name='message'),
+    url(r'^ircview/u/([0-9A-Za-z]+)$', ircviews.shorturl, name='shorturl'),
 
     # root
     url(r'^$', RedirectView.as_view(pattern_name='index', permanent=False))